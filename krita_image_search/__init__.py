@@ -1 +1,8 @@
-from .krita_image_docker import *
\ No newline at end of file
+try:
+    import krita
+except ImportError:
+    # Outside Krita only the search engine is usable, there is no docker to register
+    krita = None
+
+if krita is not None:
+    from .krita_image_docker import *
@@ -0,0 +1,4 @@
+import sys
+from krita_image_search.cli import main
+
+sys.exit(main())
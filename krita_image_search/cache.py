@@ -0,0 +1,321 @@
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Thumbnails kept on disk between sessions
+THUMBNAIL_DISK_CACHE_SIZE = 512 * 1024 * 1024
+# Compressed thumbnails kept in memory, across pages in the docker and while a batch runs on the command line
+THUMBNAIL_CACHE_SIZE = 32 * 1024 * 1024
+# Full images downloaded for import, kept on disk
+FULL_IMAGE_SPOOL_SIZE = 256 * 1024 * 1024
+
+def cacheDirectory():
+    # Shared by the docker and the command line, so caches seeded from the command line are used in Krita
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "krita_image_search"
+
+def thumbnailKey(photoId, params):
+    query = "&".join(f"{name}={params[name]}" for name in sorted(params))
+    return f"{photoId}?{query}"
+
+def parseThumbnailKey(key):
+    photoId, _, query = key.partition("?")
+    return photoId, dict(part.split("=", 1) for part in query.split("&") if part)
+
+# Params that decide which part of the photo a thumbnail shows, a stand-in variant has to agree on them
+SHAPE_PARAMS = ("fit", "crop")
+SIZE_PARAMS = ("w", "h")
+
+def dominates(variantParams, params):
+    # A cached variant can replace a request if it shows the same crop, at least as large and as good
+    for name in SHAPE_PARAMS + SIZE_PARAMS:
+        if (name in variantParams) != (name in params):
+            return False
+    if any(variantParams[name] != str(params[name]) for name in SHAPE_PARAMS if name in params):
+        return False
+    if any(int(variantParams[name]) < int(params[name]) for name in SIZE_PARAMS if name in params):
+        return False
+    return int(variantParams.get("q", 75)) >= int(params.get("q", 75))
+
+def isLarger(variantKey, params):
+    _, variantParams = parseThumbnailKey(variantKey)
+    return any(int(variantParams[name]) > int(params[name]) for name in SIZE_PARAMS if name in params)
+
+def partialKey(key):
+    # Prefix of a progressive thumbnail that is still downloading, replaced on every new scan
+    return f"{key}#partial"
+
+def isPartialKey(key):
+    return key.endswith("#partial")
+
+class ThumbnailCache:
+    # Compressed thumbnail bytes, shared between the GUI thread and search workers,
+    # optionally backed by a FileSpool that outlives the session
+    def __init__(self, budget, disk=None):
+        self.budget = budget
+        self.disk = disk
+        self.__entries = OrderedDict()
+        # Cached keys per photo id, for finding variants that can stand in for a request
+        self.__variants = {}
+        self.__size = 0
+        self.__lock = threading.Lock()
+        # Lookups answered from memory, from disk, or not at all
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.__lock:
+            data = self.__entries.get(key)
+            if data is not None:
+                self.__entries.move_to_end(key)
+                return data
+
+        # Memory miss, load from disk and keep it in memory again
+        if self.disk is None or isPartialKey(key):
+            return None
+        data = self.disk.get(key)
+        if data is not None:
+            with self.__lock:
+                self.__insert(key, data)
+        return data
+
+    def put(self, key, data):
+        with self.__lock:
+            self.__insert(key, data)
+        # Partial progressive frames are only useful while their download runs
+        if self.disk is not None and not isPartialKey(key):
+            self.disk.put(key, data)
+
+    def contains(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                return True
+        return self.disk is not None and not isPartialKey(key) and self.disk.contains(key)
+
+    def findVariant(self, photoId, params):
+        # The exact key if cached, otherwise the smallest, then best, cached variant that dominates the request.
+        # Disk entries are stored by hash, so only exact keys are found there
+        key = thumbnailKey(photoId, params)
+        with self.__lock:
+            if key in self.__entries:
+                self.hits += 1
+                return key
+        if self.disk is not None and self.disk.contains(key):
+            self.diskHits += 1
+            return key
+
+        with self.__lock:
+            best = None
+            bestRank = None
+            for variant in self.__variants.get(photoId, ()):
+                _, variantParams = parseThumbnailKey(variant)
+                if not dominates(variantParams, params):
+                    continue
+                rank = tuple(int(variantParams.get(name, 0)) for name in SIZE_PARAMS) + (-int(variantParams.get("q", 75)),)
+                if bestRank is None or rank < bestRank:
+                    best = variant
+                    bestRank = rank
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def remove(self, key):
+        with self.__lock:
+            data = self.__entries.pop(key, None)
+            if data is not None:
+                self.__size -= len(data)
+                self.__forget(key)
+
+    def size(self):
+        with self.__lock:
+            return self.__size
+
+    def setBudget(self, budget):
+        with self.__lock:
+            self.budget = budget
+            self.__evict()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__variants.clear()
+            self.__size = 0
+
+    def __insert(self, key, data):
+        old = self.__entries.pop(key, None)
+        if old is not None:
+            self.__size -= len(old)
+        self.__entries[key] = data
+        self.__size += len(data)
+        if not isPartialKey(key):
+            self.__variants.setdefault(parseThumbnailKey(key)[0], set()).add(key)
+        self.__evict()
+
+    def __forget(self, key):
+        photoId = parseThumbnailKey(key)[0]
+        variants = self.__variants.get(photoId)
+        if variants is not None:
+            variants.discard(key)
+            if not variants:
+                del self.__variants[photoId]
+
+    def __evict(self):
+        while self.__size > self.budget and len(self.__entries) > 1:
+            key, data = self.__entries.popitem(last=False)
+            self.__size -= len(data)
+            self.__forget(key)
+
+class ResultStore:
+    # Search results per query, addressed by absolute position so any page size can be sliced locally
+    def __init__(self, maxQueries=32):
+        self.maxQueries = maxQueries
+        self.__queries = OrderedDict()
+        self.__lock = threading.Lock()
+        # Upstream pages served locally, and fetched
+        self.hits = 0
+        self.misses = 0
+
+    def total(self, query):
+        with self.__lock:
+            entry = self.__queries.get(query)
+            return entry["total"] if entry is not None else None
+
+    def setTotal(self, query, total):
+        with self.__lock:
+            self.__entry(query)["total"] = total
+
+    def put(self, query, position, record):
+        with self.__lock:
+            self.__entry(query)["records"][position] = record
+
+    def records(self, query, start, end):
+        with self.__lock:
+            entry = self.__queries.get(query)
+            if entry is None:
+                return [None] * (end - start)
+            self.__queries.move_to_end(query)
+            return [entry["records"].get(position) for position in range(start, end)]
+
+    def markComplete(self, query, start, end):
+        with self.__lock:
+            self.__entry(query)["complete"].add((start, end))
+
+    def isComplete(self, query, start, end):
+        with self.__lock:
+            entry = self.__queries.get(query)
+            complete = entry is not None and (start, end) in entry["complete"]
+            if complete:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return complete
+
+    def findPrefixMatch(self, query):
+        # Most recent stored query sharing the longest prefix with what is being typed
+        with self.__lock:
+            best = None
+            bestLength = 0
+            for stored in reversed(self.__queries):
+                if self.__queries[stored]["total"] is None:
+                    continue
+                if stored.startswith(query) or query.startswith(stored):
+                    length = min(len(stored), len(query))
+                    if length > bestLength:
+                        best = stored
+                        bestLength = length
+            return best
+
+    def clear(self):
+        with self.__lock:
+            self.__queries.clear()
+
+    def __entry(self, query):
+        entry = self.__queries.get(query)
+        if entry is None:
+            entry = {"total": None, "records": {}, "complete": set()}
+            self.__queries[query] = entry
+            while len(self.__queries) > self.maxQueries:
+                self.__queries.popitem(last=False)
+        self.__queries.move_to_end(query)
+        return entry
+
+class FileSpool:
+    # Large downloads (full images) kept on disk instead of in memory, LRU bounded by budget
+    def __init__(self, directory, budget):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Pick up files left by an earlier session, oldest first
+        for path in sorted(self.directory.glob("*.bin"), key=lambda path: path.stat().st_mtime):
+            self.__entries[path.stem] = path.stat().st_size
+            self.__size += path.stat().st_size
+        with self.__lock:
+            self.__evict()
+
+    def get(self, key):
+        name = self.__name(key)
+        with self.__lock:
+            if name not in self.__entries:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(name)
+            try:
+                data = self.__path(name).read_bytes()
+            except OSError:
+                self.__size -= self.__entries.pop(name)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        name = self.__name(key)
+        path = self.__path(name)
+        tmpPath = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmpPath.write_bytes(data)
+        with self.__lock:
+            os.replace(tmpPath, path)
+            self.__size -= self.__entries.pop(name, 0)
+            self.__entries[name] = len(data)
+            self.__size += len(data)
+            self.__evict()
+
+    def contains(self, key):
+        with self.__lock:
+            return self.__name(key) in self.__entries
+
+    def size(self):
+        with self.__lock:
+            return self.__size
+
+    def __name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def __path(self, name):
+        return self.directory / f"{name}.bin"
+
+    def __evict(self):
+        while self.__size > self.budget and len(self.__entries) > 1:
+            name, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            try:
+                self.__path(name).unlink()
+            except OSError:
+                pass
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import time
+import zipfile
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from krita_image_search.vendor import aiohttp
+
+# Recorded request/response pairs, bodies and timings, for offline replay with tools/replay_server.py.
+# A cassette is a zip: cassette.json lists the responses, bodies/<sha1> holds each distinct body once.
+
+CASSETTE_VERSION = 1
+INDEX_NAME = "cassette.json"
+BODY_PREFIX = "bodies/"
+# Bodies of these types are deflated, images are stored as they came
+TEXT_TYPES = ("application/json", "text/")
+# Describe the connection rather than the response, and bodies are recorded decoded
+SKIPPED_HEADERS = ("connection", "keep-alive", "transfer-encoding", "content-encoding", "content-length")
+
+def requestKey(method, url):
+    # Method, path and query in a fixed order, the host is whatever the cassette is served from
+    parts = urlsplit(str(url))
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{method.upper()} {parts.path}?{query}"
+
+class Cassette:
+    def __init__(self, meta=None, entries=None, bodies=None):
+        # Entry: method, url, status, reason, headers, headersTime (seconds from the request to its headers),
+        # chunks ([seconds from the request, bytes] as they arrived) and body (sha1 of the whole body)
+        self.meta = meta or {}
+        self.entries = entries or []
+        self.bodies = bodies or {}
+
+    @classmethod
+    def load(cls, path):
+        with zipfile.ZipFile(path) as archive:
+            index = json.loads(archive.read(INDEX_NAME))
+            if index.get("version") != CASSETTE_VERSION:
+                raise ValueError(f"{path}: unsupported cassette version {index.get('version')}")
+            bodies = {name[len(BODY_PREFIX):]: archive.read(name) for name in archive.namelist() if name.startswith(BODY_PREFIX)}
+        return cls(index["meta"], index["entries"], bodies)
+
+    def save(self, path):
+        index = {"version": CASSETTE_VERSION, "meta": self.meta, "entries": self.entries}
+        textual = {entry["body"] for entry in self.entries if isTextual(entry["headers"])}
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr(INDEX_NAME, json.dumps(index, separators=(",", ":")), zipfile.ZIP_DEFLATED)
+            for digest, body in self.bodies.items():
+                archive.writestr(BODY_PREFIX + digest, body, zipfile.ZIP_DEFLATED if digest in textual else zipfile.ZIP_STORED)
+
+    def body(self, entry):
+        return self.bodies[entry["body"]]
+
+    def byRequest(self):
+        # requestKey -> entries in recorded order
+        responses = {}
+        for entry in self.entries:
+            responses.setdefault(requestKey(entry["method"], entry["url"]), []).append(entry)
+        return responses
+
+def isTextual(headers):
+    contentType = next((value for name, value in headers if name.lower() == "content-type"), "")
+    return contentType.startswith(TEXT_TYPES)
+
+class CassetteRecorder:
+    # Records every response a session reads to the end, give NetworkScheduler its responseClass
+    def __init__(self, meta=None):
+        self.cassette = Cassette({"recorded": time.strftime("%Y-%m-%dT%H:%M:%S"), **(meta or {})})
+        recorder = self
+
+        class RecordingResponse(aiohttp.ClientResponse):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # Created once the request is written
+                self.requestTime = time.monotonic()
+
+            async def start(self, connection):
+                await super().start(connection)
+                recorder.track(self)
+                return self
+
+        self.responseClass = RecordingResponse
+
+    def track(self, resp):
+        headersTime = time.monotonic() - resp.requestTime
+        content = resp.content
+        # Body bytes that came in with the headers are already buffered, the private deque of the vendored StreamReader
+        chunks = [[headersTime, data] for data in getattr(content, "_buffer", ())]
+        feedData = content.feed_data
+
+        def recordData(data, size=0):
+            chunks.append([time.monotonic() - resp.requestTime, data])
+            feedData(data, size)
+
+        content.feed_data = recordData
+        # Cancelled and failed responses never see their end and are left out
+        content.on_eof(lambda: self.add(resp, headersTime, chunks))
+
+    def add(self, resp, headersTime, chunks):
+        body = b"".join(data for _, data in chunks)
+        digest = hashlib.sha1(body).hexdigest()
+        self.cassette.bodies[digest] = body
+        self.cassette.entries.append({
+            "method": resp.method,
+            "url": str(resp.url),
+            "status": resp.status,
+            "reason": resp.reason,
+            "headers": [[name, value] for name, value in resp.headers.items() if name.lower() not in SKIPPED_HEADERS],
+            "headersTime": round(headersTime, 4),
+            "chunks": [[round(seconds, 4), len(data)] for seconds, data in chunks],
+            "body": digest
+        })
+
+    def save(self, path):
+        self.cassette.save(path)
+        return len(self.cassette.entries)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+from krita_image_search.cache import ThumbnailCache, ResultStore, FileSpool, isPartialKey, cacheDirectory, THUMBNAIL_DISK_CACHE_SIZE, THUMBNAIL_CACHE_SIZE, FULL_IMAGE_SPOOL_SIZE
+from krita_image_search.cassette import CassetteRecorder
+from krita_image_search.engine import SearchEngine, SearchError, SearchResult, SearchTotal, Thumbnail, IMAGE_FORMATS, FALLBACK_IMAGE_FORMAT
+from krita_image_search.records import UNSPLASH_IMAGE_URL
+from krita_image_search.scheduler import NetworkScheduler, IMPORT, THUMBNAILS, SEARCH, BACKGROUND, POOL_SIZE, LANE_LIMITS, LANE_NAMES, IMPORT_RESERVE
+
+# Headless front end for the search engine: python -m krita_image_search
+
+class Stats:
+    # Requests, payload bytes and per-lane request latency of one run
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = {}
+        self.bytes = 0
+        self.results = 0
+        self.thumbnails = 0
+        self.fetchedThumbnails = 0
+        self.downloads = 0
+        self.errors = 0
+        # TimingSummary of the session's requests, set when it ends
+        self.timings = None
+
+    def onRequest(self, lane, seconds):
+        self.latencies.setdefault(lane, []).append(seconds)
+
+    def report(self, out):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        print(f"{self.results} results, {self.thumbnails} thumbnails ({self.fetchedThumbnails} fetched), {self.downloads} downloads, {self.errors} errors", file=out)
+        print(f"{requests} requests in {elapsed:.2f}s, {requests / elapsed:.1f} req/s, {self.bytes / 1024 / 1024:.2f} MB, {self.bytes / 1024 / 1024 / elapsed:.2f} MB/s", file=out)
+        for lane in sorted(self.latencies):
+            latencies = sorted(self.latencies[lane])
+            print(f"  {LANE_NAMES[lane]:<10} {len(latencies):>5} requests  p50 {percentile(latencies, 0.5) * 1000:.0f}ms  p95 {percentile(latencies, 0.95) * 1000:.0f}ms  max {latencies[-1] * 1000:.0f}ms", file=out)
+        timings = self.timings
+        if timings is not None and timings.requests:
+            # Mean per request, where the time went between the slot and the last body byte
+            phases = "  ".join(f"{name} {seconds / timings.requests * 1000:.1f}ms" for name, seconds in timings.phases.items())
+            print(f"  connections {timings.reuseRate():.0%} reused, per request  {phases}", file=out)
+
+def percentile(values, fraction):
+    # values sorted ascending, nearest rank
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class MeteredThumbnailCache(ThumbnailCache):
+    # Counts what the engine fetched, cache hits and disk loads do not go through put
+    def __init__(self, budget, disk, stats):
+        super().__init__(budget, disk)
+        self.stats = stats
+
+    def put(self, key, data):
+        super().put(key, data)
+        if not isPartialKey(key):
+            self.stats.bytes += len(data)
+            self.stats.fetchedThumbnails += 1
+
+def parseArgs(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--pages", type=int, default=1, help="result pages per query (default 1)")
+    common.add_argument("--per-page", type=int, default=30, help="results per page (default 30)")
+    common.add_argument("--quality", type=int, default=75, help="thumbnail quality, must match the plugin's setting to seed its cache (default 75)")
+    common.add_argument("--format", choices=IMAGE_FORMATS + (FALLBACK_IMAGE_FORMAT,), default="webp", help="image format, must match the one the plugin logs at startup (default webp)")
+    common.add_argument("--justified", action="store_true", help="justified thumbnails, as with the plugin's justified layout")
+    common.add_argument("--concurrency", type=int, default=LANE_LIMITS[THUMBNAILS], help="thumbnail and download requests in flight (default %(default)s)")
+    common.add_argument("--rate-limit", type=float, default=None, metavar="REQUESTS", help="requests per second, unlimited by default")
+    common.add_argument("--base-url", default=None, help="search API base url")
+    common.add_argument("--image-base-url", default=None, help="replaces https://images.unsplash.com in result urls")
+    common.add_argument("--record", type=Path, default=None, metavar="CASSETTE", help="record every response to a cassette for tools.replay_server")
+    common.add_argument("--cache-dir", type=Path, default=cacheDirectory(), help="cache directory shared with the plugin (default %(default)s)")
+    common.add_argument("--cache-size", type=int, default=THUMBNAIL_DISK_CACHE_SIZE // 1024 // 1024, metavar="MB", help="thumbnail disk cache size (default %(default)s)")
+    common.add_argument("-v", "--verbose", action="store_true", help="log every job")
+
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search", description="Search, prefetch and download Unsplash images without Krita")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    search = commands.add_parser("search", parents=[common], help="print search results")
+    search.add_argument("query")
+
+    prefetch = commands.add_parser("prefetch", parents=[common], help="fill the plugin's thumbnail cache")
+    prefetch.add_argument("queries", nargs="*", metavar="query")
+    prefetch.add_argument("--file", type=Path, help="file with one query per line")
+
+    download = commands.add_parser("download", parents=[common], help="download full images")
+    download.add_argument("query")
+    download.add_argument("--output", type=Path, required=True, help="directory the images are written to")
+    download.add_argument("--limit", type=int, default=None, help="images to download at most")
+
+    args = parser.parse_args(argv)
+    if args.command == "prefetch":
+        if args.file is not None:
+            args.queries += [line.strip() for line in args.file.read_text(encoding="utf-8").splitlines() if line.strip()]
+        if not args.queries:
+            parser.error("prefetch needs a query or --file")
+    return args
+
+async def searchPages(engine, args, query, stats, onResult):
+    # Runs every requested page, stops early once the last page is reached
+    for pageNum in range(1, args.pages + 1):
+        totalPages = pageNum
+        async for event in engine.search(query, pageNum, args.per_page, args.quality, args.justified):
+            if isinstance(event, SearchTotal):
+                totalPages = event.totalPages
+            elif isinstance(event, SearchResult):
+                stats.results += 1
+                onResult(pageNum, event)
+            elif isinstance(event, Thumbnail):
+                stats.thumbnails += 1
+            elif isinstance(event, SearchError):
+                stats.errors += 1
+                print(f"{query}: {event.message}", file=sys.stderr)
+        if pageNum >= totalPages:
+            break
+
+async def downloadImage(engine, scheduler, record, output, stats):
+    url = engine.fullImageUrl(record.fullUrl)
+    download = engine.imageDownload(url, record.downloadLocation)
+    path = output / f"{record.id}.{engine.imageFormat}"
+
+    def onLoaded(data):
+        path.write_bytes(data)
+        stats.bytes += len(data)
+        stats.downloads += 1
+        print(path)
+
+    def onError(error):
+        stats.errors += 1
+        print(f"{record.id}: {error.message}", file=sys.stderr)
+
+    download.onLoaded = onLoaded
+    download.onError = onError
+    await scheduler.run(IMPORT, f"download {url}", download.run)
+    if not download.delivered and not download.cancelled:
+        # Refused download tracking ends an import without an error
+        stats.errors += 1
+        print(f"{record.id}: not downloaded", file=sys.stderr)
+
+async def run(args):
+    stats = Stats()
+    limits = list(LANE_LIMITS)
+    for lane in (IMPORT, THUMBNAILS, BACKGROUND):
+        limits[lane] = args.concurrency
+    # Room for the search requests and the connections only imports may use next to a full thumbnail lane
+    poolSize = max(POOL_SIZE, args.concurrency + limits[SEARCH] + IMPORT_RESERVE)
+    recorder = CassetteRecorder() if args.record is not None else None
+
+    async with NetworkScheduler(logging.getLogger(__name__), poolSize, tuple(limits), args.rate_limit, recorder and recorder.responseClass) as scheduler:
+        scheduler.onRequest = stats.onRequest
+        disk = FileSpool(args.cache_dir / "thumbnails", args.cache_size * 1024 * 1024)
+        with tempfile.TemporaryDirectory(prefix="krita_image_search_") as spoolDir:
+            engine = SearchEngine(
+                scheduler,
+                MeteredThumbnailCache(THUMBNAIL_CACHE_SIZE, disk, stats),
+                ResultStore(),
+                FileSpool(spoolDir, FULL_IMAGE_SPOOL_SIZE),
+                scheduler.logger,
+                baseUrl=args.base_url,
+                imageFormat=args.format,
+                imageBaseUrl=args.image_base_url
+            )
+            engine.thumbnailConcurrency = args.concurrency
+            if recorder is not None:
+                # Where replay serves the API and images from
+                recorder.cassette.meta.update(apiBaseUrl=engine.baseUrl, imageBaseUrl=engine.imageBaseUrl or UNSPLASH_IMAGE_URL)
+
+            if args.command == "search":
+                def printResult(pageNum, event):
+                    record = event.record
+                    print(f"{(pageNum - 1) * args.per_page + event.index + 1}\t{record.id}\t{record.width}x{record.height}\t{record.userName}\t{record.htmlLink}")
+                await searchPages(engine, args, args.query, stats, printResult)
+
+            elif args.command == "prefetch":
+                for query in args.queries:
+                    thumbnails = stats.thumbnails
+                    await searchPages(engine, args, query, stats, lambda pageNum, event: None)
+                    print(f"{query}: {stats.thumbnails - thumbnails} thumbnails cached", file=sys.stderr)
+
+            elif args.command == "download":
+                args.output.mkdir(parents=True, exist_ok=True)
+                records = []
+                await searchPages(engine, args, args.query, stats, lambda pageNum, event: records.append(event.record))
+                records = records[:args.limit]
+                await asyncio.gather(*(downloadImage(engine, scheduler, record, args.output, stats) for record in records))
+        stats.timings = scheduler.tracer.summary()
+
+    stats.report(sys.stderr)
+    if recorder is not None:
+        print(f"{recorder.save(args.record)} responses recorded to {args.record}", file=sys.stderr)
+    return 1 if stats.errors else 0
+
+def main(argv=None):
+    args = parseArgs(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s %(name)s - %(levelname)s - %(message)s")
+    try:
+        return asyncio.run(run(args))
+    except KeyboardInterrupt:
+        return 130
+    except BrokenPipeError:
+        # Output piped into head and the like
+        sys.stdout = None
+        return 1
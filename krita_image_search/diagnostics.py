@@ -0,0 +1,93 @@
+import time
+from collections import Counter
+from krita_image_search.scheduler import LANE_NAMES
+from krita_image_search.timings import TimingSummary
+
+class SearchBreakdown:
+    # Where the time of one search went, network phases come from its job's requests, the rest is measured by the front end
+    def __init__(self, name, task, decodeTime):
+        self.name = name
+        self.task = task
+        self.started = time.monotonic()
+        self.finished = None
+        self.layout = 0
+        # Decode time of the thumbnail store when the search started
+        self.decodeStart = decodeTime
+
+    def network(self):
+        job = self.task.job
+        return TimingSummary(list(job.requests)) if job is not None else None
+
+def ratio(hits, misses):
+    total = hits + misses
+    return f"{hits / total:.0%}" if total else "-"
+
+def milliseconds(seconds):
+    return f"{seconds * 1000:.0f} ms"
+
+def megabytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+class Diagnostics:
+    # Live numbers of one docker for its diagnostics window, read on the GUI thread while the scheduler's runs
+    def __init__(self, scheduler, thumbnailCache, resultStore, fullImageSpool, thumbnailStore):
+        self.scheduler = scheduler
+        self.thumbnailCache = thumbnailCache
+        self.resultStore = resultStore
+        self.fullImageSpool = fullImageSpool
+        self.thumbnailStore = thumbnailStore
+        self.lastSearch = None
+
+    def searchStarted(self, name, task):
+        self.lastSearch = SearchBreakdown(name, task, self.thumbnailStore.decodeTime)
+
+    def searchFinished(self, task):
+        if self.lastSearch is not None and self.lastSearch.task is task:
+            self.lastSearch.finished = time.monotonic()
+
+    def addLayoutTime(self, task, seconds):
+        if self.lastSearch is not None and self.lastSearch.task is task:
+            self.lastSearch.layout += seconds
+
+    def rows(self):
+        # (name, text) pairs, always the same names in display order
+        rows = []
+        search = self.lastSearch
+        if search is None:
+            rows.append(("Last search", "none yet"))
+        elif search.finished is None:
+            rows.append(("Last search", f"{search.name}, running for {milliseconds(time.monotonic() - search.started)}"))
+        else:
+            rows.append(("Last search", f"{search.name}, {milliseconds(search.finished - search.started)}"))
+        network = search.network() if search is not None else None
+        if network is not None and network.requests:
+            phases = ", ".join(f"{name} {milliseconds(seconds)}" for name, seconds in network.phases.items() if seconds)
+            rows.append(("Network", f"{network.requests} requests in {milliseconds(network.wall)}, {megabytes(network.bytesReceived)}"))
+            rows.append(("Phases", f"{phases}, summed over requests"))
+        else:
+            rows.append(("Network", "-"))
+            rows.append(("Phases", "-"))
+        if search is not None:
+            decode = self.thumbnailStore.decodeTime - search.decodeStart
+            rows.append(("Parse / decode / layout", f"{milliseconds(search.task.parseTime)} / {milliseconds(decode)} / {milliseconds(search.layout)}"))
+        else:
+            rows.append(("Parse / decode / layout", "-"))
+
+        cache = self.thumbnailCache
+        rows.append(("Thumbnail cache", f"{ratio(cache.hits + cache.diskHits, cache.misses)} hits ({cache.hits} memory, {cache.diskHits} disk, {cache.misses} fetched)"))
+        rows.append(("Result cache", f"{ratio(self.resultStore.hits, self.resultStore.misses)} of pages served locally"))
+        rows.append(("Import spool", f"{ratio(self.fullImageSpool.hits, self.fullImageSpool.misses)} of imports prefetched"))
+
+        tracer = self.scheduler.tracer
+        rows.append(("Received", f"{megabytes(tracer.bytesReceived)} in {tracer.requests} requests"))
+        rows.append(("Connection reuse", f"{tracer.reuseRate():.0%}" if tracer.requests else "-"))
+        lanes = Counter(job.lane for job in self.scheduler.jobs())
+        rows.append(("Jobs in flight", ", ".join(f"{name} {lanes[lane]}" for lane, name in enumerate(LANE_NAMES))))
+        rows.append(("Thumbnail memory", f"{megabytes(self.thumbnailStore.decodedBytes())} decoded, {megabytes(self.thumbnailStore.encodedBytes())} compressed"))
+        if tracer.rateLimitRemaining is None:
+            rows.append(("API quota", "not reported"))
+        elif tracer.rateLimit is None:
+            rows.append(("API quota", f"{tracer.rateLimitRemaining} requests left"))
+        else:
+            rows.append(("API quota", f"{tracer.rateLimitRemaining} of {tracer.rateLimit} requests left"))
+        return rows
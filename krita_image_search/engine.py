@@ -0,0 +1,602 @@
+import asyncio
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from krita_image_search.cache import thumbnailKey, partialKey, isPartialKey, isLarger
+from krita_image_search.json_stream import SearchResultParser
+from krita_image_search.records import PhotoRecord
+from krita_image_search.scheduler import IMPORT, THUMBNAILS, SEARCH, BACKGROUND, PREFETCH
+
+API_BASE_URL = "https://joshapiproxy.fly.dev/api/unsplash"
+
+# Thumbnail fetch priority tiers
+VISIBLE = 0
+NEXT_SCREEN = 1
+OFFSCREEN = 2
+
+THUMBNAIL_CONCURRENCY = 6
+# Offscreen fetches only run when nothing visible is in flight, and only this many at once
+OFFSCREEN_CONCURRENCY = 2
+
+# Ready thumbnails are delivered at most once per display frame
+FRAME_INTERVAL = 0.016
+READY_QUEUE_SIZE = 64
+
+# Upstream pages are always requested at the API maximum and sliced locally to the UI page size
+UPSTREAM_PER_PAGE = 30
+
+# Formats imgix can output, smallest first, used when the front end can decode them
+IMAGE_FORMATS = ("avif", "webp")
+FALLBACK_IMAGE_FORMAT = "jpg"
+# imgix output for progressive thumbnails, and the JPEG start-of-scan marker that separates their passes
+PROGRESSIVE_IMAGE_FORMAT = "pjpg"
+SCAN_MARKER = b"\xff\xda"
+
+# Error kinds
+RATE_LIMITED = "rate_limited"
+SERVER_ERROR = "server_error"
+THUMBNAILS_FAILED = "thumbnails_failed"
+
+def ignore(*args):
+    pass
+
+class SearchError:
+    __slots__ = ("kind", "message")
+
+    def __init__(self, kind, message):
+        self.kind = kind
+        self.message = message
+
+    def __repr__(self):
+        return f"SearchError({self.kind!r}, {self.message!r})"
+
+class SearchTotal:
+    __slots__ = ("total", "totalPages")
+
+    def __init__(self, total, totalPages):
+        self.total = total
+        self.totalPages = totalPages
+
+    def __repr__(self):
+        return f"SearchTotal({self.total}, pages={self.totalPages})"
+
+class SearchResult:
+    # Position on the requested page and the photo's metadata
+    __slots__ = ("index", "record")
+
+    def __init__(self, index, record):
+        self.index = index
+        self.record = record
+
+    def __repr__(self):
+        return f"SearchResult({self.index}, {self.record!r})"
+
+class Thumbnail:
+    # Compressed bytes stay in the engine's thumbnail cache under key
+    __slots__ = ("index", "key", "partial")
+
+    def __init__(self, index, key, partial=False):
+        self.index = index
+        self.key = key
+        self.partial = partial
+
+    def __repr__(self):
+        return f"Thumbnail({self.index}, {self.key!r}{', partial' if self.partial else ''})"
+
+class SearchEngine:
+    # Search, thumbnail and download pipeline without any Qt, front ends subscribe to the on* callbacks
+    baseUrl = API_BASE_URL
+    # Replaces the image CDN in result urls when set, for a stand-in server
+    imageBaseUrl = None
+
+    def __init__(self, scheduler, thumbnailCache, resultStore, fullImageSpool, logger, baseUrl=None, imageFormat=FALLBACK_IMAGE_FORMAT, resizeImage=None, imageBaseUrl=None):
+        self.scheduler = scheduler
+        self.thumbnailCache = thumbnailCache
+        self.resultStore = resultStore
+        self.fullImageSpool = fullImageSpool
+        self.logger = logger
+        if baseUrl is not None:
+            self.baseUrl = baseUrl
+        if imageBaseUrl is not None:
+            self.imageBaseUrl = imageBaseUrl
+        self.imageFormat = imageFormat
+        # resizeImage(data, params) returns (encoded bytes, fm) of a smaller variant, or None when not possible
+        self.resizeImage = resizeImage
+        self.thumbnailConcurrency = THUMBNAIL_CONCURRENCY
+
+    def thumbnailParams(self, quality, justified, progressive=False):
+        # The format is part of the params and so of the thumbnail cache key
+        imageFormat = PROGRESSIVE_IMAGE_FORMAT if progressive else self.imageFormat
+        if justified:
+            return {
+                "h": 500,
+                "q": quality,
+                "fm": imageFormat
+            }
+        return {
+            "h": 500,
+            "w": 500,
+            "q": quality,
+            "fm": imageFormat,
+            "fit": "crop",
+            "crop": "faces,focalpoint"
+        }
+
+    def fullImageUrl(self, url):
+        # Imported images are requested in the same format, replacing the fm=jpg of the API url
+        parts = urlsplit(url)
+        query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name != "fm"]
+        query.append(("fm", self.imageFormat))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def imageSearch(self, query, pageNum, perPage, quality, justified, progressive=False):
+        return ImageSearch(self, query, pageNum, perPage, quality, justified, progressive)
+
+    async def search(self, query, pageNum=1, perPage=UPSTREAM_PER_PAGE, quality=75, justified=False, progressive=False, lookahead=READY_QUEUE_SIZE):
+        # Pull-style search on the scheduler's loop, yields SearchTotal, SearchResult, Thumbnail and SearchError as they happen.
+        # At most lookahead thumbnails are fetched ahead of the caller, leaving the loop cancels everything still running
+        search = self.imageSearch(query, pageNum, perPage, quality, justified, progressive)
+        search.events = asyncio.Queue()
+        search.lookahead = lookahead
+        search.frameInterval = 0
+        task = asyncio.ensure_future(self.scheduler.run(SEARCH, f"search '{query}' page {pageNum}", search.run))
+        task.add_done_callback(lambda _: search.events.put_nowait(None))
+        try:
+            while True:
+                event = await search.events.get()
+                if event is None:
+                    break
+                yield event
+                if isinstance(event, Thumbnail) and not event.partial:
+                    search.consumed()
+        finally:
+            if not task.done():
+                search.cancel()
+                await asyncio.wait([task])
+
+    def imageDownload(self, url, downloadLocation, prefetch=False):
+        return ImageDownload(self, url, downloadLocation, prefetch)
+
+class ImageSearch:
+    # One page of results and its thumbnails, callbacks are called on the scheduler's loop
+    def __init__(self, engine, query, pageNum, perPage, quality, justified, progressive=False):
+        self.engine = engine
+        self.scheduler = engine.scheduler
+        self.logger = engine.logger
+        self.thumbnailCache = engine.thumbnailCache
+        self.resultStore = engine.resultStore
+        self.query = query
+        self.pageNum = pageNum
+        self.perPage = perPage
+        self.quality = quality
+        self.justified = justified
+        self.progressive = progressive
+        self.start = (pageNum - 1) * perPage
+        self.end = self.start + perPage
+        self.totalReported = False
+        self.visibleRange = (0, perPage - 1)
+        self.job = None
+        self.cancelled = False
+        self.failedThumbnails = 0
+        # Seconds spent parsing the search JSON into records, for diagnostics
+        self.parseTime = 0
+        self.scheduleChanged = None
+        self.results = []
+        self.pendingThumbnails = []
+        self.listingComplete = False
+        self.inFlight = [0, 0, 0]
+        self.readyThumbnails = None
+        self.frameInterval = FRAME_INTERVAL
+        # Set by SearchEngine.search() for pull-style consumers, thumbnails fetched but not yet taken are bounded by lookahead
+        self.events = None
+        self.lookahead = None
+        self.ahead = 0
+
+        # onTotal(pageNum, totalPages), onListed(records), onThumbnails([(position, key)]), onError(error), onFinished()
+        self.onTotal = ignore
+        self.onListed = ignore
+        self.onThumbnails = ignore
+        self.onError = ignore
+        self.onFinished = ignore
+
+    def submit(self):
+        self.job = self.scheduler.submit(SEARCH, f"search '{self.query}' page {self.pageNum}", self.run)
+        return self.job
+
+    def cancel(self):
+        # Thread-safe, the job stops at its next await
+        self.cancelled = True
+        if self.job is not None:
+            self.job.cancel()
+
+    def publish(self, event):
+        if self.events is not None:
+            self.events.put_nowait(event)
+
+    def consumed(self):
+        self.ahead -= 1
+        self.wakeFetchers()
+
+    def reportError(self, error):
+        self.onError(error)
+        self.publish(error)
+
+    def updateViewport(self, firstVisible, lastVisible):
+        # Thread-safe, re-ranks pending thumbnails on the scheduler's loop
+        self.visibleRange = (firstVisible, lastVisible)
+        loop = self.scheduler.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.wakeFetchers)
+            except RuntimeError:
+                pass
+
+    def wakeFetchers(self):
+        if self.scheduleChanged is not None:
+            self.scheduleChanged.set()
+
+    def thumbnailTier(self, index):
+        first, last = self.visibleRange
+        screen = last - first + 1
+        if first <= index <= last:
+            return VISIBLE
+        if first - screen <= index <= last + screen:
+            return NEXT_SCREEN
+        return OFFSCREEN
+
+    def thumbnailPriority(self, index):
+        first, _ = self.visibleRange
+        return (self.thumbnailTier(index), abs(index - first))
+
+    async def getSearchJson(self, session, upstreamPage):
+        params = {
+            "query": self.query,
+            "page": upstreamPage,
+            "per_page": UPSTREAM_PER_PAGE
+        }
+        try:
+            async with self.scheduler.slot(SEARCH), session.get(f"{self.engine.baseUrl}/search", params=params, trace_request_ctx=self.job) as resp:
+                if resp.status == 429:
+                    self.reportError(SearchError(RATE_LIMITED, "Too many requests, please try again later"))
+                elif resp.status == 200:
+                    await self.streamSearchJson(resp, upstreamPage)
+                    return True
+                elif resp.status >= 500:
+                    self.reportError(SearchError(SERVER_ERROR, "Server Error"))
+                return False
+        except Exception as e:
+            self.logger.error(e)
+            self.reportError(SearchError(SERVER_ERROR, "Server Error"))
+            return False
+
+    async def streamSearchJson(self, resp, upstreamPage):
+        # Decode as UTF-8 without charset sniffing and hand out each result as soon as it is complete
+        parser = SearchResultParser()
+        offset = (upstreamPage - 1) * UPSTREAM_PER_PAGE
+        async for chunk in resp.content.iter_any():
+            started = time.perf_counter()
+            results = parser.feed(chunk)
+            # Some responses put total after the results, it is then only known once the body is closed
+            if parser.header is not None and parser.header.get("total") is not None:
+                self.setTotal(parser.header["total"])
+            offset = self.addResults(results, offset)
+            self.parseTime += time.perf_counter() - started
+
+        started = time.perf_counter()
+        results, json = parser.close()
+        self.setTotal(json["total"])
+        self.addResults(results, offset)
+        self.parseTime += time.perf_counter() - started
+        self.resultStore.markComplete(self.query, (upstreamPage - 1) * UPSTREAM_PER_PAGE, upstreamPage * UPSTREAM_PER_PAGE)
+
+    async def loadUpstreamPage(self, session, upstreamPage):
+        start = (upstreamPage - 1) * UPSTREAM_PER_PAGE
+        end = start + UPSTREAM_PER_PAGE
+        if self.resultStore.isComplete(self.query, start, end):
+            # Already fetched for this query, no network call needed
+            self.setTotal(self.resultStore.total(self.query))
+            self.addRecords([record for record in self.resultStore.records(self.query, start, end) if record is not None], start)
+            return True
+        return await self.getSearchJson(session, upstreamPage)
+
+    async def loadResults(self, session):
+        firstUpstream = self.start // UPSTREAM_PER_PAGE + 1
+        lastUpstream = (self.end - 1) // UPSTREAM_PER_PAGE + 1
+        for upstreamPage in range(firstUpstream, lastUpstream + 1):
+            if not await self.loadUpstreamPage(session, upstreamPage):
+                return
+            total = self.resultStore.total(self.query)
+            if total is not None and upstreamPage * UPSTREAM_PER_PAGE >= total:
+                return
+
+    def setTotal(self, total):
+        if self.totalReported:
+            return
+
+        self.resultStore.setTotal(self.query, total)
+        totalPages = -(-total // self.perPage)
+        self.onTotal(self.pageNum, totalPages)
+        self.publish(SearchTotal(total, totalPages))
+        self.totalReported = True
+
+    def addResults(self, results, offset):
+        # Keep compact records only, the parsed JSON dicts are dropped here
+        records = [PhotoRecord.fromJson(im_result, self.engine.baseUrl, self.engine.imageBaseUrl) for im_result in results]
+        for i, record in enumerate(records):
+            self.resultStore.put(self.query, offset + i, record)
+        self.addRecords(records, offset)
+        return offset + len(records)
+
+    def addRecords(self, records, offset):
+        # Only positions on the requested page are listed and get thumbnails
+        records = records[max(0, self.start - offset):max(0, self.end - offset)]
+        if not records:
+            return
+
+        start = len(self.results)
+        self.results.extend(records)
+        self.job.total = len(self.results)
+        self.onListed(records)
+        for index in range(start, len(self.results)):
+            self.publish(SearchResult(index, self.results[index]))
+
+        # Wake the thumbnail fetchers for the new positions
+        self.pendingThumbnails.extend(range(start, len(self.results)))
+        self.scheduleChanged.set()
+
+    async def getImageTask(self, session, index, record, params, lane, progressive=False):
+        url = record.rawUrl
+        key = thumbnailKey(record.id, params)
+        try:
+            # A cached variant at least as large and as good is used instead of fetching, smaller only needs a local downscale
+            variant = self.thumbnailCache.findVariant(record.id, params)
+            if variant is not None and isLarger(variant, params):
+                variant = self.downscaleVariant(variant, record.id, params)
+
+            # Compressed bytes stay in the shared cache, only the key is handed out
+            if variant is not None:
+                key = variant
+            else:
+                async with self.scheduler.slot(lane), session.get(url, params=params, trace_request_ctx=self.job) as resp:
+                    # An error page must not end up in the cache as a thumbnail
+                    resp.raise_for_status()
+                    if progressive:
+                        data = await self.readProgressive(resp, index, key)
+                    else:
+                        data = await resp.read()
+                    self.thumbnailCache.put(key, data)
+            # Waits here when the consumer is behind and the ready queue is full
+            await self.readyThumbnails.put((index, key))
+            self.job.received += 1
+            return True
+        except Exception as e:
+            self.logger.error(e)
+            self.failedThumbnails += 1
+            self.thumbnailCache.remove(partialKey(key))
+            return False
+
+    def downscaleVariant(self, variant, photoId, params):
+        # Key of the downscaled copy, its fm is the format it was actually encoded in
+        data = self.thumbnailCache.get(variant)
+        if data is None or self.engine.resizeImage is None:
+            return None
+
+        resized = self.engine.resizeImage(data, params)
+        if resized is None:
+            return None
+        data, imageFormat = resized
+        key = thumbnailKey(photoId, {**params, "fm": imageFormat})
+        self.thumbnailCache.put(key, data)
+        return key
+
+    async def readProgressive(self, resp, index, key):
+        # Every completed scan of a progressive JPEG decodes to a coarser version of the whole image,
+        # so the prefix up to each new scan is handed out while the rest is still downloading
+        partial = partialKey(key)
+        data = bytearray()
+        firstScan = -1
+        async for chunk in resp.content.iter_any():
+            # Start one byte back so a marker split across chunks is found
+            searchFrom = max(0, len(data) - 1)
+            data.extend(chunk)
+            if firstScan < 0:
+                firstScan = data.find(SCAN_MARKER)
+            scan = data.rfind(SCAN_MARKER, searchFrom)
+            # Partial frames are skipped rather than waited for when the consumer is behind
+            if firstScan >= 0 and scan > firstScan and not self.readyThumbnails.full():
+                self.thumbnailCache.put(partial, bytes(data[:scan]))
+                self.readyThumbnails.put_nowait((index, partial))
+        return bytes(data)
+
+    async def deliverThumbnails(self):
+        loop = asyncio.get_running_loop()
+        lastDelivery = 0
+        done = False
+        while not done:
+            batch = [await self.readyThumbnails.get()]
+            delay = lastDelivery + self.frameInterval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # Coalesce everything that became ready during this frame into one delivery
+            while not self.readyThumbnails.empty():
+                batch.append(self.readyThumbnails.get_nowait())
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if batch:
+                self.onThumbnails(batch)
+            for index, key in batch:
+                self.publish(Thumbnail(index, key, isPartialKey(key)))
+            lastDelivery = loop.time()
+
+    async def thumbnailFetcher(self, session, params):
+        while self.pendingThumbnails or not self.listingComplete:
+            if not self.pendingThumbnails:
+                # Results are still streaming in
+                self.scheduleChanged.clear()
+                await self.scheduleChanged.wait()
+                continue
+
+            index = min(self.pendingThumbnails, key=self.thumbnailPriority)
+            tier = self.thumbnailTier(index)
+            if tier == OFFSCREEN and (self.inFlight[VISIBLE] + self.inFlight[NEXT_SCREEN] > 0 or self.inFlight[OFFSCREEN] >= OFFSCREEN_CONCURRENCY):
+                # Defer offscreen work until the tiles the user can see are done
+                self.scheduleChanged.clear()
+                await self.scheduleChanged.wait()
+                continue
+
+            if self.lookahead is not None and self.ahead >= self.lookahead:
+                # The consumer has not taken what was fetched so far
+                self.scheduleChanged.clear()
+                await self.scheduleChanged.wait()
+                continue
+
+            self.pendingThumbnails.remove(index)
+            self.inFlight[tier] += 1
+            self.ahead += 1
+            try:
+                # Tiles on screen get the thumbnail lane, and are the only ones worth decoding more than once
+                lane = THUMBNAILS if tier == VISIBLE else BACKGROUND
+                if not await self.getImageTask(session, index, self.results[index], params, lane, self.progressive and tier == VISIBLE):
+                    self.ahead -= 1
+            finally:
+                self.inFlight[tier] -= 1
+                self.scheduleChanged.set()
+
+    async def run(self, job):
+        # The job may start before submit() has returned on the calling thread
+        self.job = job
+        try:
+            if not self.cancelled:
+                await self.searchAndFetch()
+        except asyncio.CancelledError:
+            self.logger.info(f"Search for '{self.query}' page {self.pageNum} cancelled")
+        self.onFinished()
+
+    async def searchAndFetch(self):
+        # Requests go through the scheduler's shared connection pool
+        session = self.scheduler.session
+        params = self.engine.thumbnailParams(self.quality, self.justified, self.progressive)
+
+        # Fetchers start before the listing is complete and pick up results as they are parsed,
+        # visible-first and re-ranked whenever the viewport changes
+        self.scheduleChanged = asyncio.Event()
+        self.readyThumbnails = asyncio.Queue(READY_QUEUE_SIZE)
+        delivery = asyncio.create_task(self.deliverThumbnails())
+        fetchers = [asyncio.create_task(self.thumbnailFetcher(session, params)) for _ in range(self.engine.thumbnailConcurrency)]
+        try:
+            await self.loadResults(session)
+            self.listingComplete = True
+            self.scheduleChanged.set()
+
+            await asyncio.gather(*fetchers)
+            await self.readyThumbnails.put(None)
+            await delivery
+        finally:
+            for task in fetchers + [delivery]:
+                task.cancel()
+
+        if self.failedThumbnails > 0:
+            self.reportError(SearchError(THUMBNAILS_FAILED, f"Cannot load {self.failedThumbnails} image(s)"))
+
+class ImageDownload:
+    # Full image for import, or a prefetch that only fills the spool until promoted by a click
+    def __init__(self, engine, url, downloadLocation, prefetch=False):
+        self.engine = engine
+        self.scheduler = engine.scheduler
+        self.logger = engine.logger
+        self.fullImageSpool = engine.fullImageSpool
+        self.url = url
+        self.downloadLocation = downloadLocation
+        self.prefetch = prefetch
+        self.promoted = not prefetch
+        self.delivered = False
+        self.job = None
+        self.cancelled = False
+
+        # onLoaded(data), onError(error), onFinished()
+        self.onLoaded = ignore
+        self.onError = ignore
+        self.onFinished = ignore
+
+    def submit(self):
+        self.job = self.scheduler.submit(self.lane(), f"download {self.url}", self.run)
+        return self.job
+
+    def cancel(self):
+        self.cancelled = True
+        if self.job is not None:
+            self.job.cancel()
+
+    def promote(self):
+        # Thread-safe, checked by the job once the image is in the spool
+        self.promoted = True
+        if self.job is not None:
+            self.scheduler.setLane(self.job, IMPORT)
+
+    def progress(self):
+        return self.job.progress() if self.job is not None else 0
+
+    def lane(self):
+        return IMPORT if self.promoted else PREFETCH
+
+    async def trackDownload(self, session):
+        # Only sent for an image that is actually imported, which waits for it in its own lane
+        try:
+            async with self.scheduler.slot(self.lane(), self.job), session.get(self.downloadLocation, trace_request_ctx=self.job) as resp:
+                if resp.status == 200:
+                    return True
+                else:
+                    return False
+        except Exception as e:
+            self.logger.error(e)
+            return False
+
+    async def fetchFullImage(self, session):
+        try:
+            async with self.scheduler.slot(self.lane(), self.job), session.get(self.url, trace_request_ctx=self.job) as resp:
+                if resp.status == 200:
+                    self.job.total = resp.content_length
+                    chunks = []
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        chunks.append(chunk)
+                        self.job.received += len(chunk)
+                    data = b"".join(chunks)
+                    self.fullImageSpool.put(self.url, data)
+                    return data
+                elif resp.status >= 500 and self.promoted:
+                    self.onError(SearchError(SERVER_ERROR, "Server Error"))
+        except Exception as e:
+            self.logger.error(e)
+            if self.promoted:
+                self.onError(SearchError(SERVER_ERROR, "Server Error"))
+        return None
+
+    async def run(self, job):
+        self.job = job
+        try:
+            if not self.cancelled:
+                await self.importImage(self.scheduler.session)
+        except asyncio.CancelledError:
+            self.logger.info(f"Download of {self.url} cancelled")
+        self.onFinished()
+
+    async def importImage(self, session):
+        data = self.fullImageSpool.get(self.url)
+        if data is None and not self.prefetch:
+            # The ping and the download go out together, the image is only delivered when both succeed
+            tracked, data = await asyncio.gather(self.trackDownload(session), self.fetchFullImage(session))
+            if not tracked or data is None:
+                return
+        elif data is None:
+            data = await self.fetchFullImage(session)
+            if data is None or not self.promoted:
+                return
+            if not await self.trackDownload(session):
+                return
+        elif not self.promoted or not await self.trackDownload(session):
+            # A prefetch that finds the image already in the spool has nothing to do until it is clicked
+            return
+
+        self.delivered = True
+        self.onLoaded(data)
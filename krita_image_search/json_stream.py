@@ -0,0 +1,99 @@
+import codecs
+import json
+import re
+
+# Characters that change nesting, plus the quote that starts a string
+STRUCTURAL = re.compile(r'[{}\[\]"]')
+# Rest of a string after its opening quote, only matches once the closing quote has arrived
+STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+class SearchResultParser:
+    # Incrementally parses a search response, returning each element of "results" as soon as it is complete
+    def __init__(self, arrayKey="results"):
+        self.arrayKey = arrayKey
+        self.header = None
+        self.__decoder = codecs.getincrementaldecoder("utf-8")()
+        self.__text = ""
+        self.__pos = 0
+        self.__depth = 0
+        self.__lastKey = None
+        self.__inArray = False
+        self.__elementStart = None
+        # Text outside the results array, parsed at the end for total, total_pages, etc.
+        self.__skeleton = []
+        self.__skeletonStart = 0
+
+    def feed(self, data, final=False):
+        self.__text += self.__decoder.decode(data, final)
+        results = []
+        text = self.__text
+        while True:
+            match = STRUCTURAL.search(text, self.__pos)
+            if match is None:
+                self.__pos = len(text)
+                break
+
+            char = match.group()
+            i = match.start()
+            if char == '"':
+                end = STRING_BODY.match(text, i + 1)
+                if end is None:
+                    # String continues in the next chunk
+                    self.__pos = i
+                    break
+                if self.__depth == 1 and not self.__inArray:
+                    self.__lastKey = text[i + 1:end.end() - 1]
+                self.__pos = end.end()
+                continue
+
+            if char in "{[":
+                self.__depth += 1
+                if char == "[" and self.__depth == 2 and self.__lastKey == self.arrayKey:
+                    self.__openArray(text[self.__skeletonStart:i + 1])
+                elif char == "{" and self.__inArray and self.__depth == 3:
+                    self.__elementStart = i
+            else:
+                self.__depth -= 1
+                if char == "}" and self.__inArray and self.__depth == 2 and self.__elementStart is not None:
+                    results.append(json.loads(text[self.__elementStart:i + 1]))
+                    self.__elementStart = None
+                elif char == "]" and self.__inArray and self.__depth == 1:
+                    self.__inArray = False
+                    self.__skeletonStart = i
+
+            self.__pos = i + 1
+
+        self.__trim()
+        return results
+
+    def close(self):
+        results = self.feed(b"", final=True)
+        if self.__skeletonStart is not None:
+            self.__skeleton.append(self.__text[self.__skeletonStart:])
+        document = json.loads("".join(self.__skeleton))
+        return results, document
+
+    def __openArray(self, headerText):
+        self.__inArray = True
+        self.__skeleton.append(headerText)
+        self.__skeletonStart = None
+        # Fields before the array (total, total_pages) are usable before any result arrives
+        try:
+            self.header = json.loads(headerText + "]}")
+        except ValueError:
+            self.header = None
+
+    def __trim(self):
+        keep = self.__pos
+        for mark in (self.__elementStart, self.__skeletonStart):
+            if mark is not None:
+                keep = min(keep, mark)
+        if keep == 0:
+            return
+
+        self.__text = self.__text[keep:]
+        self.__pos -= keep
+        if self.__elementStart is not None:
+            self.__elementStart -= keep
+        if self.__skeletonStart is not None:
+            self.__skeletonStart -= keep
@@ -1,12 +1,20 @@
 from PyQt5.QtWidgets import QLabel, QLineEdit, QWidget, QScrollArea, QVBoxLayout, QHBoxLayout, QPushButton
-from PyQt5.QtCore import Qt, QThread, QSize
+from PyQt5.QtCore import Qt, QCoreApplication, QSize, QTimer
 from PyQt5.QtGui import QMovie, QPixmap, QCursor, QPalette
 from krita import *
-from krita_image_search.widgets import FlowLayout, PaginationWidget, PropertiesWindow, ImageTile
+from krita_image_search.widgets import FlowLayout, PaginationWidget, PropertiesWindow, DiagnosticsWindow, ImageTile, TilePool
+from krita_image_search.thumbnails import ThumbnailStore
+from krita_image_search.cache import ThumbnailCache, ResultStore, FileSpool, partialKey, isPartialKey, parseThumbnailKey, cacheDirectory, THUMBNAIL_DISK_CACHE_SIZE, THUMBNAIL_CACHE_SIZE, FULL_IMAGE_SPOOL_SIZE
 from krita_image_search.resources import *
 from krita_image_search.workers import *
+from krita_image_search.scheduler import NetworkScheduler
+from krita_image_search.engine import SearchEngine
+from krita_image_search.diagnostics import Diagnostics
 
+import functools
 import logging
+import tempfile
+import time
 from pathlib import Path
 
 BASE_PATH = Path(__file__).parent
@@ -17,16 +25,40 @@ logging.basicConfig(
     filemode="w", 
     format='%(asctime)s %(name)s - %(levelname)s - %(message)s'
 )
+# The plugin's own info lines (image format, per-job timing breakdowns) go to the log too, other libraries stay at warnings
+logging.getLogger("krita_image_search").setLevel(logging.INFO)
+
+# Typing pause before a live search goes to the network (ms)
+LIVE_SEARCH_DELAY = 350
+# Hover time before the import-size image is prefetched (ms)
+PREFETCH_DWELL = 300
+# A prefetch past this fraction keeps going when the pointer leaves
+PREFETCH_KEEP_PROGRESS = 0.5
 
 class Krita_Image_Docker(DockWidget):
     def __init__(self):
         super().__init__()
         self.query = ""
         self.pageOffset = 2
+        self.imageSearchWorker = None
+        self.imageTiles = []
+        self.justified = False
+        self.provisionalResults = False
+        self.importWorkers = set()
+        self.hoveredTile = None
+        self.prefetchWorker = None
 
         # Init logging
         self.logger: logging.Logger = logging.getLogger(__name__)
 
+        # Pick the smallest image format this Qt can decode once, before any request is made
+        self.logger.info(f"Requesting images as {preferredImageFormat()}")
+
+        # Init network scheduler, searches, imports and prefetches share its connection pool by priority lane
+        self.scheduler = NetworkScheduler(self.logger)
+        self.scheduler.start()
+        QCoreApplication.instance().aboutToQuit.connect(self.scheduler.stop)
+
         # Init Qt DockWidget
         self.initWidget()
 
@@ -45,8 +77,16 @@ class Krita_Image_Docker(DockWidget):
         loadingGif.start()
         self.loadingIcon.hide()
 
-        # Init image area
+        # Init image area, the same scroll area and grid are reused for every page
         self.imageArea = QScrollArea(mainWidget)
+        self.imageArea.setWidgetResizable(True)
+        imageGrid = QWidget(self.imageArea)
+        imageGrid.setLayout(FlowLayout(imageGrid))
+        self.imageArea.setWidget(imageGrid)
+
+        # Decode only the thumbnails near the viewport
+        self.imageArea.verticalScrollBar().valueChanged.connect(self.updateVisibleThumbnails)
+        self.imageArea.verticalScrollBar().rangeChanged.connect(self.updateVisibleThumbnails)
 
         # Init error label
         self.infoLabel = QLabel()
@@ -64,6 +104,7 @@ class Krita_Image_Docker(DockWidget):
         self.searchBar = QLineEdit(header)
         self.searchBar.setPlaceholderText("Search")
         self.searchBar.textChanged.connect(self.updateQuery)
+        self.searchBar.returnPressed.connect(lambda: self.liveSearchTimer.stop())
         self.searchBar.returnPressed.connect(lambda: self.searchImage(self.query, 1))
         self.searchBar.returnPressed.connect(self.pagination.disableButtons)
 
@@ -78,7 +119,49 @@ class Krita_Image_Docker(DockWidget):
         iconSize = int(Krita.instance().readSetting("KritaImageSearch", "IconSize", "100"))
         perPage = int(Krita.instance().readSetting("KritaImageSearch", "ImagesPerPage", "10"))
         quality = int(Krita.instance().readSetting("KritaImageSearch", "Quality", "75"))
-        self.propertiesWindow = PropertiesWindow(mainWidget, mainWidget.palette().color(QPalette.Base), iconSize, perPage, quality, self.propertiesButton)
+        memoryBudget = int(Krita.instance().readSetting("KritaImageSearch", "ThumbnailMemoryBudget", "128"))
+        justified = bool(int(Krita.instance().readSetting("KritaImageSearch", "JustifiedRows", "0")))
+        liveSearch = bool(int(Krita.instance().readSetting("KritaImageSearch", "LiveSearch", "0")))
+        progressive = bool(int(Krita.instance().readSetting("KritaImageSearch", "ProgressiveThumbnails", "0")))
+        self.propertiesWindow = PropertiesWindow(mainWidget, mainWidget.palette().color(QPalette.Base), iconSize, perPage, quality, memoryBudget, justified, liveSearch, progressive, self.propertiesButton)
+
+        # Init live search debounce timer
+        self.liveSearchTimer = QTimer(self)
+        self.liveSearchTimer.setSingleShot(True)
+        self.liveSearchTimer.setInterval(LIVE_SEARCH_DELAY)
+        self.liveSearchTimer.timeout.connect(lambda: self.searchImage(self.query, 1))
+
+        # Init thumbnail store, decoded pixmaps are bounded by the memory budget.
+        # Compressed thumbnails also go to the disk cache the command line prefetch fills
+        thumbnailDisk = FileSpool(cacheDirectory() / "thumbnails", THUMBNAIL_DISK_CACHE_SIZE)
+        self.thumbnailCache = ThumbnailCache(THUMBNAIL_CACHE_SIZE, thumbnailDisk)
+        self.resultStore = ResultStore()
+
+        # Init full image spool, filled by imports and hover prefetches
+        self.fullImageDir = tempfile.TemporaryDirectory(prefix="krita_image_search_")
+        self.fullImageSpool = FileSpool(self.fullImageDir.name, FULL_IMAGE_SPOOL_SIZE)
+
+        # Init search engine, the Qt-free pipeline the workers adapt to signals.
+        # The urls have no settings UI, they point the plugin at a stand-in server
+        baseUrl = Krita.instance().readSetting("KritaImageSearch", "ApiBaseUrl", "") or None
+        imageBaseUrl = Krita.instance().readSetting("KritaImageSearch", "ImageBaseUrl", "") or None
+        self.engine = SearchEngine(self.scheduler, self.thumbnailCache, self.resultStore, self.fullImageSpool, self.logger, baseUrl, preferredImageFormat(), resizeImage, imageBaseUrl)
+        self.prefetchTimer = QTimer(self)
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.setInterval(PREFETCH_DWELL)
+        self.prefetchTimer.timeout.connect(self.startPrefetch)
+        self.thumbnailStore = ThumbnailStore(memoryBudget * 1024 * 1024, self.thumbnailCache, self)
+        self.thumbnailStore.usageChanged.connect(self.propertiesWindow.updateMemoryUsage)
+        self.propertiesWindow.memoryBudgetSpinbox.valueChanged.connect(lambda value: self.thumbnailStore.setBudget(value * 1024 * 1024))
+
+        # Init diagnostics window, opened from the properties window
+        self.diagnostics = Diagnostics(self.scheduler, self.thumbnailCache, self.resultStore, self.fullImageSpool, self.thumbnailStore)
+        self.diagnosticsWindow = DiagnosticsWindow(mainWidget, self.diagnostics.rows)
+        self.propertiesWindow.diagnosticsButton.clicked.connect(self.diagnosticsWindow.toggleHidden)
+
+        # Init tile pool, tiles are rebound to new results instead of recreated per page
+        self.tilePool = TilePool(self.newImageTile, self.propertiesWindow.perPageSpinbox.maximum())
+        self.propertiesWindow.iconSizeSlider.valueChanged.connect(self.updateIconSize)
 
         # Attach widgets to header widget
         header.layout().addWidget(self.searchBar)
@@ -95,32 +178,76 @@ class Krita_Image_Docker(DockWidget):
     def canvasChanged(self, canvas):
         pass
 
-    def createNewImageArea(self):
-        self.widget().layout().removeWidget(self.imageArea)
-        self.imageArea = QScrollArea(self.widget())
-        self.imageArea.setWidgetResizable(True)
-        
-        imageGrid = QWidget(self.widget())
-        imageGrid.setLayout(FlowLayout(imageGrid))
-
-        self.imageArea.setWidget(imageGrid)
-        self.widget().layout().addWidget(self.imageArea)
+    def clearImageArea(self):
+        # Return every tile of the previous page to the pool and drop its decoded pixmaps
+        layout = self.imageArea.widget().layout()
+        item = layout.takeAt(0)
+        while item:
+            self.tilePool.release(item.widget())
+            item = layout.takeAt(0)
+        layout.invalidate()
+        self.imageTiles = []
+
+        self.thumbnailStore.releaseAll()
+        self.imageArea.verticalScrollBar().setValue(0)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateThumbnailPriorities()
+
+    def visibleResultRange(self):
+        # Tiles sit in API order, so the visible slots map directly to result positions
+        visibleRect = self.imageArea.widget().visibleRegion().boundingRect()
+        visible = [i for i, imageTile in enumerate(self.imageTiles) if visibleRect.intersects(imageTile.geometry())]
+        if visible:
+            return (visible[0], visible[-1])
+        return (0, self.propertiesWindow.perPage - 1)
+
+    def updateThumbnailPriorities(self):
+        if self.imageSearchWorker is not None:
+            self.imageSearchWorker.updateViewport(*self.visibleResultRange())
+
+    def updateVisibleThumbnails(self):
+        self.updateThumbnailPriorities()
+        imageGrid = self.imageArea.widget()
+        margin = self.propertiesWindow.iconSize
+        visibleRect = imageGrid.visibleRegion().boundingRect().adjusted(0, -margin, 0, margin)
+        layout = imageGrid.layout()
+        for i in range(layout.count()):
+            imageTile = layout.itemAt(i).widget()
+            if imageTile.key is None:
+                continue
+            if visibleRect.intersects(imageTile.geometry()):
+                self.thumbnailStore.pixmap(imageTile.key)
+            else:
+                self.thumbnailStore.release(imageTile.key)
 
     def createPagination(self, pageNum, totalPages):
         self.pagination.update(pageNum, 2, totalPages)
             
     def searchImage(self, query, pageNum):
+        # A newer search supersedes whatever is still running
+        self.cancelSearch()
+
         if query == "" or pageNum <= 0:
+            if self.propertiesWindow.liveSearch:
+                self.provisionalResults = False
+                self.clearImageArea()
             self.resetSearch()
-            self.loadingIcon.hide()
+            self.updateLoadingIcon()
             return
         
         # Clear error message
         self.infoLabel.setText("")
         self.infoLabel.hide()
 
-        # Clear image area
-        self.createNewImageArea()
+        # Clear image area, unless it shows cached results that the network answer will replace
+        if not self.provisionalResults:
+            self.clearImageArea()
+        self.justified = self.propertiesWindow.justified
+        layout = self.imageArea.widget().layout()
+        layout.justified = self.justified
+        layout.rowHeight = self.propertiesWindow.iconSize
 
         # Show loading icon
         self.loadingIcon.show()
@@ -128,65 +255,221 @@ class Krita_Image_Docker(DockWidget):
         # Set pagination button's query
         self.pagination.setQuery(query)
 
-        # Create thread for search API worker
-        self.searchApiThread = QThread()
-        self.searchApiWorker = ImageSearchWorker(query, pageNum, self.propertiesWindow.perPage, self.propertiesWindow.quality, self.logger)
-        self.searchApiWorker.moveToThread(self.searchApiThread)
-        
-        self.searchApiThread.started.connect(self.searchApiWorker.run)
-        self.searchApiWorker.finished.connect(self.searchApiThread.quit)
-        self.searchApiWorker.finished.connect(self.searchApiWorker.deleteLater)
-        self.searchApiThread.finished.connect(self.searchApiThread.deleteLater)
-        
-        self.searchApiThread.start()
+        # Create search job
+        worker = ImageSearchWorker(self.engine, query, pageNum, self.propertiesWindow.perPage, self.propertiesWindow.quality, self.justified, self.propertiesWindow.progressive)
+        self.imageSearchWorker = worker
+        self.updateThumbnailPriorities()
+
+        if not self.propertiesWindow.liveSearch:
+            self.searchBar.setEnabled(False)
+        # Slots get the worker itself to tell a superseded search from the current one
+        worker.finished.connect(functools.partial(self.searchFinished, worker))
+        worker.listed.connect(functools.partial(self.receiveImageTiles, worker))
+        worker.imLoaded.connect(functools.partial(self.receiveThumbnails, worker))
+        worker.onError.connect(functools.partial(self.receiveSearchError, worker))
+        worker.queried.connect(functools.partial(self.receivePagination, worker))
+        self.diagnostics.searchStarted(f"'{query}' page {pageNum}", worker.task)
+        worker.submit()
+
+    def isCurrentSearch(self, worker):
+        # Signals queued by a cancelled worker may still arrive after a new search started
+        return worker is self.imageSearchWorker
+
+    def cancelSearch(self):
+        if self.imageSearchWorker is not None:
+            self.imageSearchWorker.cancel()
+            self.imageSearchWorker = None
+
+    def searchFinished(self, worker):
+        if not self.isCurrentSearch(worker):
+            return
+
+        self.imageSearchWorker = None
+        self.diagnostics.searchFinished(worker.task)
+        if self.provisionalResults:
+            # Nothing came back to replace the cached results
+            self.provisionalResults = False
+            self.clearImageArea()
+        self.resetSearch()
+        self.updateLoadingIcon()
+        self.pagination.enableButtons()
+
+    def showCachedResults(self, query):
+        # Show results of a stored query that prefix-matches what is being typed
+        match = self.resultStore.findPrefixMatch(query)
+        if match is None:
+            return
 
-        self.searchBar.setEnabled(False)
-        self.searchApiThread.finished.connect(self.resetSearch)
-        self.searchApiThread.finished.connect(self.loadingIcon.hide)
-        self.searchApiThread.finished.connect(self.pagination.enableButtons)
-        self.searchApiWorker.imLoaded.connect(self.createImageTile)
-        self.searchApiWorker.onError.connect(self.handleSearchError)
-        self.searchApiWorker.queried.connect(self.createPagination)
+        # A search still delivering thumbnails by tile index would paint them over the cached tiles
+        self.cancelSearch()
+        records = [record for record in self.resultStore.records(match, 0, self.propertiesWindow.perPage) if record is not None]
+        params = self.engine.thumbnailParams(self.propertiesWindow.quality, self.propertiesWindow.justified, self.propertiesWindow.progressive)
+        self.clearImageArea()
+        self.justified = self.propertiesWindow.justified
+        self.imageArea.widget().layout().justified = self.justified
+        self.createImageTiles(records)
+        variants = [(index, self.thumbnailCache.findVariant(record.id, params)) for index, record in enumerate(records)]
+        self.loadThumbnails([(index, key) for index, key in variants if key is not None])
+        self.provisionalResults = True
 
     def getFullImage(self, fullUrl, download_location):
         self.loadingIcon.show()
+        # Clicked before the hover dwell ran out, the import replaces the prefetch
+        self.prefetchTimer.stop()
 
-        self.searchApiThread = QThread()
-        self.searchApiWorker = ImageDownloadWorker(fullUrl, download_location, self.logger)
-        self.searchApiWorker.moveToThread(self.searchApiThread)
+        # Promote a running hover prefetch of the same image instead of downloading it again
+        if self.prefetchWorker is not None and self.prefetchWorker.url == fullUrl:
+            self.prefetchWorker.promote()
+            return
 
-        self.searchApiThread.started.connect(self.searchApiWorker.run)
-        self.searchApiWorker.finished.connect(self.searchApiThread.quit)
-        self.searchApiWorker.finished.connect(self.searchApiWorker.deleteLater)
-        self.searchApiThread.finished.connect(self.searchApiThread.deleteLater)
-        self.searchApiThread.finished.connect(self.loadingIcon.hide)
+        # Imports run in the highest lane, alongside any search instead of replacing it
+        worker = ImageDownloadWorker(self.engine, fullUrl, download_location)
+        self.importWorkers.add(worker)
+        worker.finished.connect(functools.partial(self.importFinished, worker))
+        worker.fullImageLoaded.connect(self.copyToClipboard)
+        worker.submit()
 
-        self.searchApiThread.start()
-        self.searchApiWorker.fullImageLoaded.connect(self.copyToClipboard)
-        
+    def importFinished(self, worker):
+        self.importWorkers.discard(worker)
+        self.updateLoadingIcon()
+
+    def updateLoadingIcon(self):
+        promotedPrefetch = self.prefetchWorker is not None and self.prefetchWorker.promoted
+        if self.imageSearchWorker is None and not self.importWorkers and not promotedPrefetch:
+            self.loadingIcon.hide()
+
+    def newImageTile(self):
+        imageTile = ImageTile(self.thumbnailStore, self.propertiesWindow.iconSize, self.imageArea.widget())
+        imageTile.hovered.connect(lambda isHovered: self.tileHovered(imageTile, isHovered))
+        return imageTile
+
+    def tileHovered(self, imageTile, isHovered):
+        if isHovered:
+            self.hoveredTile = imageTile
+            self.prefetchTimer.start()
+            return
+
+        self.prefetchTimer.stop()
+        self.hoveredTile = None
+        # Drop a prefetch the user moved away from early, unless it was clicked or is mostly done
+        worker = self.prefetchWorker
+        if worker is not None and not worker.promoted and worker.progress() < PREFETCH_KEEP_PROGRESS:
+            worker.cancel()
+            self.prefetchWorker = None
+
+    def startPrefetch(self):
+        if self.hoveredTile is None or self.hoveredTile.record is None:
+            return
+
+        # One prefetch at a time, its lane only gets connections that searches and imports leave free
+        record = self.hoveredTile.record
+        if self.prefetchWorker is not None:
+            return
+        url = self.engine.fullImageUrl(record.fullUrl)
+        if self.fullImageSpool.contains(url) or any(worker.url == url for worker in self.importWorkers):
+            return
+
+        self.prefetchWorker = ImageDownloadWorker(self.engine, url, record.downloadLocation, prefetch=True)
+        self.prefetchWorker.fullImageLoaded.connect(self.copyToClipboard)
+        self.prefetchWorker.onError.connect(self.handleSearchError)
+        self.prefetchWorker.finished.connect(functools.partial(self.prefetchFinished, self.prefetchWorker))
+        self.prefetchWorker.submit()
+
+    def prefetchFinished(self, worker):
+        if worker is self.prefetchWorker:
+            self.prefetchWorker = None
+        if worker.promoted:
+            self.updateLoadingIcon()
+            # Clicked too late for the prefetch to deliver it, import from the spool
+            if not worker.delivered and not worker.cancelled:
+                self.getFullImage(worker.url, worker.download_location)
 
     def resetSearch(self):
         self.searchBar.setEnabled(True)
+        if self.propertiesWindow.liveSearch:
+            return
         self.searchBar.setText("")
         self.query = ""
 
-    def createImageTile(self, data, json):
-        fullUrl = json["urls"]["full"]
-        download_location = json["links"]["download_location"]
-
-        downloadCallback = lambda: self.getFullImage(fullUrl, download_location)
-        imageTile = ImageTile(data, downloadCallback, self.propertiesWindow.iconSize, json, self.imageArea)
-
-        # Image tile behavior
-        self.propertiesWindow.iconSizeSlider.valueChanged.connect(imageTile.updateIconSize)
+    def receiveImageTiles(self, worker, results):
+        if not self.isCurrentSearch(worker):
+            return
 
-        # Disconnect signal and slot when image tiles are destroyed
-        imageTile.imageBtn.destroyed.connect(lambda: self.propertiesWindow.iconSizeSlider.valueChanged.disconnect(imageTile.updateIconSize))
+        # The network answer replaces provisional cached results
+        started = time.perf_counter()
+        if self.provisionalResults:
+            self.provisionalResults = False
+            self.clearImageArea()
+        self.createImageTiles(results)
+        self.diagnostics.addLayoutTime(worker.task, time.perf_counter() - started)
+
+    def createImageTiles(self, results):
+        # Reserve a fixed slot per result in API order so arriving thumbnails never reflow the grid
+        imageGrid = self.imageArea.widget()
+        imageGrid.setUpdatesEnabled(False)
+        for record in results:
+            self.imageTiles.append(self.createImageTile(record))
+        imageGrid.layout().activate()
+        imageGrid.setUpdatesEnabled(True)
+        self.updateThumbnailPriorities()
+
+    def createImageTile(self, record):
+        downloadCallback = lambda: self.getFullImage(self.engine.fullImageUrl(record.fullUrl), record.downloadLocation)
+        imageTile = self.tilePool.acquire()
+        imageTile.updateIconSize(self.propertiesWindow.iconSize)
+        imageTile.bind(record, downloadCallback, self.justified)
 
         self.imageArea.widget().layout().addWidget(imageTile)
+        imageTile.show()
+        return imageTile
+
+    def receiveThumbnails(self, worker, batch):
+        if self.isCurrentSearch(worker):
+            started = time.perf_counter()
+            self.loadThumbnails(batch)
+            self.diagnostics.addLayoutTime(worker.task, time.perf_counter() - started)
+
+    def receiveSearchError(self, worker, msg):
+        if self.isCurrentSearch(worker):
+            self.handleSearchError(msg)
+
+    def receivePagination(self, worker, pageNum, totalPages):
+        if self.isCurrentSearch(worker):
+            self.createPagination(pageNum, totalPages)
+
+    def loadThumbnails(self, batch):
+        # One repaint per delivered batch instead of one per thumbnail
+        imageGrid = self.imageArea.widget()
+        imageGrid.setUpdatesEnabled(False)
+        for index, key in batch:
+            if index >= len(self.imageTiles):
+                continue
+            imageTile = self.imageTiles[index]
+            # Never show a thumbnail on the tile of another photo
+            if imageTile.record is None or parseThumbnailKey(key)[0] != imageTile.record.id:
+                continue
+            if isPartialKey(key):
+                # A newer scan of the same thumbnail, the previous one has to be decoded again
+                self.thumbnailStore.release(key)
+            elif imageTile.key == partialKey(key):
+                self.thumbnailStore.discard(imageTile.key)
+            imageTile.setThumbnail(key)
+        imageGrid.setUpdatesEnabled(True)
+        self.thumbnailStore.updateUsage()
+
+    def updateIconSize(self, value):
+        layout = self.imageArea.widget().layout()
+        layout.rowHeight = value
+        for i in range(layout.count()):
+            layout.itemAt(i).widget().updateIconSize(value)
+        layout.invalidate()
 
     def updateQuery(self, text):
         self.query = text
+        if self.propertiesWindow.liveSearch:
+            if text != "":
+                self.showCachedResults(text)
+            self.liveSearchTimer.start()
 
     def handleSearchError(self, msg):
         self.infoLabel.setText(msg)
@@ -0,0 +1,65 @@
+# Hosts in the API's own urls, replaced by the proxy's and by a stand-in image server
+UNSPLASH_API_URL = "https://api.unsplash.com"
+UNSPLASH_IMAGE_URL = "https://images.unsplash.com"
+
+class PhotoRecord:
+    # Only the fields the docker uses, instead of the full per-photo search JSON
+    __slots__ = ("id", "rawUrl", "fullUrl", "downloadLocation", "htmlLink", "userName", "userLink", "width", "height", "color", "blurHash")
+
+    def __init__(self, id, rawUrl, fullUrl, downloadLocation, htmlLink, userName, userLink, width, height, color, blurHash):
+        setField = super().__setattr__
+        setField("id", id)
+        setField("rawUrl", rawUrl)
+        setField("fullUrl", fullUrl)
+        setField("downloadLocation", downloadLocation)
+        setField("htmlLink", htmlLink)
+        setField("userName", userName)
+        setField("userLink", userLink)
+        setField("width", width)
+        setField("height", height)
+        setField("color", color)
+        setField("blurHash", blurHash)
+
+    @classmethod
+    def fromJson(cls, json, apiBaseUrl=None, imageBaseUrl=None):
+        downloadLocation = json["links"]["download_location"]
+        if apiBaseUrl is not None:
+            downloadLocation = downloadLocation.replace(UNSPLASH_API_URL, apiBaseUrl)
+        rawUrl = json["urls"]["raw"]
+        fullUrl = json["urls"]["full"]
+        if imageBaseUrl is not None:
+            rawUrl = rawUrl.replace(UNSPLASH_IMAGE_URL, imageBaseUrl)
+            fullUrl = fullUrl.replace(UNSPLASH_IMAGE_URL, imageBaseUrl)
+
+        return cls(
+            json["id"],
+            rawUrl,
+            fullUrl,
+            downloadLocation,
+            json["links"]["html"],
+            json["user"]["name"],
+            json["user"]["links"]["html"],
+            json.get("width") or 0,
+            json.get("height") or 0,
+            json.get("color"),
+            json.get("blur_hash")
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, PhotoRecord) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"PhotoRecord(id={self.id!r}, {self.width}x{self.height})"
+
+    @property
+    def aspectRatio(self):
+        return self.width / self.height if self.height else 1
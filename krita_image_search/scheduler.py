@@ -0,0 +1,265 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import threading
+from krita_image_search.timings import RequestTracer, TimingSummary
+from krita_image_search.vendor import aiohttp
+
+# Request lanes, lower is served first. Off-screen thumbnails and the hover prefetch have a lane each,
+# so neither can take all the slots of the other
+IMPORT = 0
+THUMBNAILS = 1
+SEARCH = 2
+BACKGROUND = 3
+PREFETCH = 4
+LANE_NAMES = ("import", "thumbnails", "search", "background", "prefetch")
+
+# Requests in flight per lane, all lanes share one connection pool
+LANE_LIMITS = (2, 6, 2, 2, 2)
+POOL_SIZE = 8
+# Connections only imports may use, so a click never waits for a free one
+IMPORT_RESERVE = 1
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+PREEMPTED = "preempted"
+
+class Job:
+    # One search, import or prefetch, made of any number of lane-scheduled requests
+    def __init__(self, lane, name):
+        self.lane = lane
+        self.name = name
+        self.state = QUEUED
+        self.received = 0
+        self.total = None
+        self.cancelRequested = False
+        self.preempted = False
+        # RequestTiming of every request made with trace_request_ctx=job
+        self.requests = []
+        self.loop = None
+        self.task = None
+
+    def progress(self):
+        if not self.total:
+            return 0
+        return min(1, self.received / self.total)
+
+    def cancel(self):
+        # Thread-safe, a job that has not started yet sees the flag when it does
+        self.cancelRequested = True
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.__cancelTask)
+            except RuntimeError:
+                pass
+
+    def __cancelTask(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def __repr__(self):
+        return f"Job({self.name!r}, {LANE_NAMES[self.lane]}, {self.state}, {self.progress():.0%})"
+
+class NetworkScheduler:
+    # Runs every network job on one event loop, its own thread or the caller's, and hands out connections by lane priority
+    def __init__(self, logger, poolSize=POOL_SIZE, laneLimits=LANE_LIMITS, requestsPerSecond=None, responseClass=None):
+        self.logger = logger
+        self.poolSize = poolSize
+        self.laneLimits = laneLimits
+        # Requests started per second across all lanes, unlimited when None
+        self.requestsPerSecond = requestsPerSecond
+        # ClientResponse subclass for the session, a CassetteRecorder's to record it
+        self.responseClass = responseClass or aiohttp.ClientResponse
+        # Phase timings of every request, per job and for the session
+        self.tracer = RequestTracer()
+        # onRequest(lane, seconds) is called on the loop when a request releases its slot
+        self.onRequest = None
+        self.loop = None
+        self.session = None
+        self.__thread = None
+        self.__ready = threading.Event()
+        self.__jobs = set()
+        self.__waiters = []
+        self.__order = itertools.count()
+        self.__active = [0] * len(laneLimits)
+        self.__nextRequest = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        # Runs the scheduler on the calling loop instead of a thread of its own, for headless callers
+        self.loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(limit=self.poolSize)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10), response_class=self.responseClass,
+                                             trace_configs=[self.tracer.traceConfig()])
+
+    async def close(self):
+        # Cancel what is left and close the pool
+        for job in list(self.__jobs):
+            job.cancel()
+        tasks = [job.task for job in self.__jobs if job.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+        await self.session.close()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__runLoop, name="KritaImageSearchNetwork", daemon=True)
+        self.__thread.start()
+        self.__ready.wait()
+
+    def stop(self):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(loop.stop)
+        except RuntimeError:
+            return
+        self.__thread.join(5)
+
+    def submit(self, lane, name, jobFunction):
+        # Thread-safe, jobFunction(job) is awaited on the scheduler's loop
+        job = Job(lane, name)
+        job.loop = self.loop
+        self.loop.call_soon_threadsafe(self.__startJob, job, jobFunction)
+        return job
+
+    async def run(self, lane, name, jobFunction):
+        # Runs a job to completion on the scheduler's loop, which has to be the calling one
+        job = Job(lane, name)
+        job.loop = self.loop
+        await self.__startJob(job, jobFunction)
+        return job
+
+    def setLane(self, job, lane):
+        # Thread-safe. A prefetch clicked by the user becomes an import and is no longer preempted,
+        # and its requests still waiting for a slot move to the new lane
+        job.lane = lane
+        self.loop.call_soon_threadsafe(self.__moveWaiters, job, lane)
+
+    def jobs(self):
+        return list(self.__jobs)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane, job=None):
+        # Holds one pooled connection in the given lane for the duration of a request.
+        # A request of a job waits in the job's lane if setLane moves it, and then holds a slot of that lane
+        future = self.loop.create_future()
+        heapq.heappush(self.__waiters, [lane, next(self.__order), future, job])
+        self.__dispatch()
+        try:
+            lane = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.__release(future.result())
+            raise
+        started = None
+        try:
+            await self.__throttle()
+            started = self.loop.time()
+            yield
+        finally:
+            self.__release(lane)
+            if self.onRequest is not None and started is not None:
+                self.onRequest(lane, self.loop.time() - started)
+
+    def __runLoop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.open())
+        self.__ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.close())
+        self.loop.close()
+
+    def __startJob(self, job, jobFunction):
+        if job.lane == IMPORT:
+            self.__preempt()
+        self.__jobs.add(job)
+        return self.loop.create_task(self.__runJob(job, jobFunction))
+
+    async def __runJob(self, job, jobFunction):
+        job.task = asyncio.current_task()
+        self.__setState(job, RUNNING)
+        try:
+            await jobFunction(job)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.error(e)
+        finally:
+            job.task = None
+            self.__jobs.discard(job)
+            if job.requests:
+                self.logger.info(f"{job.name}: {TimingSummary(job.requests)}")
+            if job.preempted:
+                self.__setState(job, PREEMPTED)
+            elif job.cancelRequested:
+                self.__setState(job, CANCELLED)
+            else:
+                self.__setState(job, DONE)
+
+    def __preempt(self):
+        # Imports take the bandwidth of running prefetches
+        for job in list(self.__jobs):
+            if job.lane == PREFETCH and not job.cancelRequested:
+                job.preempted = True
+                job.cancel()
+
+    def __setState(self, job, state):
+        job.state = state
+        self.logger.info(f"{job}")
+
+    def __fits(self, lane):
+        reserve = 0 if lane == IMPORT else IMPORT_RESERVE
+        return self.__active[lane] < self.laneLimits[lane] and sum(self.__active) < self.poolSize - reserve
+
+    def __dispatch(self):
+        # Grant waiting requests in lane order, a lane at its own limit does not hold back the ones below it
+        blocked = []
+        while self.__waiters:
+            entry = heapq.heappop(self.__waiters)
+            lane, _, future, _ = entry
+            if future.done():
+                continue
+            if self.__fits(lane):
+                self.__active[lane] += 1
+                future.set_result(lane)
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(self.__waiters, entry)
+
+    def __moveWaiters(self, job, lane):
+        moved = False
+        for entry in self.__waiters:
+            if entry[3] is job and entry[0] != lane:
+                entry[0] = lane
+                moved = True
+        if moved:
+            heapq.heapify(self.__waiters)
+            self.__dispatch()
+
+    async def __throttle(self):
+        # Spaces request starts evenly, a granted slot waits for its turn
+        if not self.requestsPerSecond:
+            return
+        now = self.loop.time()
+        start = max(now, self.__nextRequest)
+        self.__nextRequest = start + 1 / self.requestsPerSecond
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def __release(self, lane):
+        self.__active[lane] -= 1
+        self.__dispatch()
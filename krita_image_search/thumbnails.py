@@ -0,0 +1,85 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QPixmap
+from collections import OrderedDict
+import time
+
+class ThumbnailStore(QObject):
+    # Decoded bytes in use, compressed bytes held, decoded budget in bytes
+    usageChanged = pyqtSignal(int, int, int)
+
+    def __init__(self, budget, cache, parent=None):
+        super().__init__(parent)
+        self.budget = budget
+        self.cache = cache
+        self.__decoded = OrderedDict()
+        self.__decodedBytes = 0
+        # Seconds spent decoding this session, for diagnostics
+        self.decodeTime = 0
+
+    def contains(self, key):
+        return self.cache.contains(key)
+
+    def isDecoded(self, key):
+        return key in self.__decoded
+
+    def pixmap(self, key):
+        pixmap = self.__decoded.get(key)
+        if pixmap is not None:
+            self.__decoded.move_to_end(key)
+            return pixmap
+
+        # Compressed bytes are canonical, decode on demand
+        data = self.cache.get(key)
+        pixmap = QPixmap()
+        if data is None:
+            return pixmap
+        started = time.perf_counter()
+        loaded = pixmap.loadFromData(data)
+        self.decodeTime += time.perf_counter() - started
+        if not loaded:
+            return pixmap
+
+        self.__decoded[key] = pixmap
+        self.__decodedBytes += self.pixmapCost(pixmap)
+        self.__evict()
+        self.updateUsage()
+        return pixmap
+
+    def release(self, key):
+        pixmap = self.__decoded.pop(key, None)
+        if pixmap is not None:
+            self.__decodedBytes -= self.pixmapCost(pixmap)
+            self.updateUsage()
+
+    def discard(self, key):
+        # Drop both the decoded and the compressed copy, for superseded partial thumbnails
+        self.release(key)
+        self.cache.remove(key)
+
+    def releaseAll(self):
+        self.__decoded.clear()
+        self.__decodedBytes = 0
+        self.updateUsage()
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.__evict()
+        self.updateUsage()
+
+    def decodedBytes(self):
+        return self.__decodedBytes
+
+    def encodedBytes(self):
+        return self.cache.size()
+
+    def updateUsage(self):
+        self.usageChanged.emit(self.__decodedBytes, self.cache.size(), self.budget)
+
+    def pixmapCost(self, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def __evict(self):
+        # Drop least recently painted pixmaps first, but always keep the one just decoded
+        while self.__decodedBytes > self.budget and len(self.__decoded) > 1:
+            _, pixmap = self.__decoded.popitem(last=False)
+            self.__decodedBytes -= self.pixmapCost(pixmap)
@@ -0,0 +1,161 @@
+import collections
+import time
+from krita_image_search.vendor import aiohttp
+
+# Request phases, in the order they happen
+PHASES = ("queue", "dns", "connect", "send", "wait", "transfer")
+# Finished requests kept for session-wide numbers
+RECENT_REQUESTS = 1000
+
+class RequestTiming:
+    # time.monotonic() stamps of one request, None for phases it skipped or has not reached
+    __slots__ = ("method", "url", "start", "queueStart", "queueEnd", "dnsStart", "dnsEnd", "connectStart", "connectEnd",
+                 "reused", "sent", "firstByte", "end", "status", "bytesReceived", "failed")
+
+    def __init__(self, method, url, start):
+        self.method = method
+        self.url = url
+        self.start = start
+        self.queueStart = None
+        self.queueEnd = None
+        self.dnsStart = None
+        self.dnsEnd = None
+        self.connectStart = None
+        self.connectEnd = None
+        self.reused = False
+        self.sent = None
+        self.firstByte = None
+        self.end = None
+        self.status = None
+        self.bytesReceived = 0
+        self.failed = False
+
+    def phases(self):
+        # Seconds per phase, connect includes TLS and leaves out DNS, wait is the server and proxy up to the response headers
+        dns = span(self.dnsStart, self.dnsEnd)
+        connect = span(self.connectStart, self.connectEnd)
+        if connect is not None and dns is not None:
+            connect = max(0, connect - dns)
+        connected = self.connectEnd or self.queueEnd or self.start
+        return {
+            "queue": span(self.queueStart, self.queueEnd),
+            "dns": dns,
+            "connect": connect,
+            "send": span(connected, self.sent),
+            "wait": span(self.sent, self.firstByte),
+            "transfer": span(self.firstByte, self.end)
+        }
+
+    def __repr__(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases().items() if seconds is not None)
+        return f"RequestTiming({self.method} {self.url}, {self.status}, {'reused' if self.reused else 'new'}, {phases}, {self.bytesReceived} bytes)"
+
+def span(start, end):
+    if start is None or end is None:
+        return None
+    return end - start
+
+class TimingSummary:
+    # Totals over a set of requests, phase times add up across concurrent requests
+    def __init__(self, timings):
+        timings = list(timings)
+        self.requests = len(timings)
+        self.reused = sum(1 for timing in timings if timing.reused)
+        self.failed = sum(1 for timing in timings if timing.failed)
+        self.bytesReceived = sum(timing.bytesReceived for timing in timings)
+        self.phases = dict.fromkeys(PHASES, 0)
+        for timing in timings:
+            for name, seconds in timing.phases().items():
+                if seconds is not None:
+                    self.phases[name] += seconds
+        ends = [timing.end or timing.firstByte for timing in timings if timing.end or timing.firstByte]
+        # First request start to last body end
+        self.wall = max(ends) - min(timing.start for timing in timings) if ends else 0
+
+    def reuseRate(self):
+        return self.reused / self.requests if self.requests else 0
+
+    def __str__(self):
+        phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items() if seconds)
+        failed = f", {self.failed} failed" if self.failed else ""
+        return (f"{self.requests} requests ({self.reused} reused connections{failed}) in {self.wall * 1000:.0f}ms, "
+                f"{self.bytesReceived / 1024:.0f} KB, summed over requests {phases or 'none'}")
+
+class RequestTracer:
+    # Times every request of a session through aiohttp's tracing signals. A request made with trace_request_ctx=job
+    # is added to job.requests, so each search and import gets its own breakdown
+    def __init__(self, recentRequests=RECENT_REQUESTS):
+        self.recent = collections.deque(maxlen=recentRequests)
+        self.requests = 0
+        self.reused = 0
+        self.bytesReceived = 0
+        # Last API quota seen in X-Ratelimit headers, None until a response carries them
+        self.rateLimit = None
+        self.rateLimitRemaining = None
+
+    def traceConfig(self):
+        traceConfig = aiohttp.TraceConfig()
+        traceConfig.on_request_start.append(self.onRequestStart)
+        traceConfig.on_connection_queued_start.append(self.stamp("queueStart"))
+        traceConfig.on_connection_queued_end.append(self.stamp("queueEnd"))
+        traceConfig.on_dns_resolvehost_start.append(self.stamp("dnsStart"))
+        traceConfig.on_dns_resolvehost_end.append(self.stamp("dnsEnd"))
+        traceConfig.on_connection_create_start.append(self.stamp("connectStart"))
+        traceConfig.on_connection_create_end.append(self.stamp("connectEnd"))
+        traceConfig.on_connection_reuseconn.append(self.onReuse)
+        traceConfig.on_request_headers_sent.append(self.stamp("sent"))
+        traceConfig.on_request_end.append(self.onRequestEnd)
+        traceConfig.on_request_exception.append(self.onRequestException)
+        return traceConfig
+
+    def stamp(self, name):
+        async def onSignal(session, context, params):
+            timing = getattr(context, "timing", None)
+            if timing is not None:
+                setattr(timing, name, time.monotonic())
+        return onSignal
+
+    async def onRequestStart(self, session, context, params):
+        context.timing = RequestTiming(params.method, params.url, time.monotonic())
+        job = context.trace_request_ctx
+        if job is not None:
+            job.requests.append(context.timing)
+
+    async def onReuse(self, session, context, params):
+        context.timing.reused = True
+
+    async def onRequestEnd(self, session, context, params):
+        # Called once the headers are in, the body is timed by the stream reaching its end
+        timing = context.timing
+        timing.firstByte = time.monotonic()
+        timing.status = params.response.status
+        headers = params.response.headers
+        if headers.get("X-Ratelimit-Remaining", "").isdigit():
+            self.rateLimitRemaining = int(headers["X-Ratelimit-Remaining"])
+            self.rateLimit = int(headers["X-Ratelimit-Limit"]) if headers.get("X-Ratelimit-Limit", "").isdigit() else None
+        content = params.response.content
+
+        def onEof():
+            timing.end = time.monotonic()
+            timing.bytesReceived = content.total_bytes
+            self.finish(timing)
+
+        content.on_eof(onEof)
+
+    async def onRequestException(self, session, context, params):
+        timing = context.timing
+        timing.failed = True
+        timing.end = time.monotonic()
+        self.finish(timing)
+
+    def finish(self, timing):
+        self.recent.append(timing)
+        self.requests += 1
+        self.reused += timing.reused
+        self.bytesReceived += timing.bytesReceived
+
+    def reuseRate(self):
+        return self.reused / self.requests if self.requests else 0
+
+    def summary(self):
+        return TimingSummary(self.recent)
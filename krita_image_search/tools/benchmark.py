@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from krita_image_search.cache import ThumbnailCache, ResultStore, FileSpool, THUMBNAIL_CACHE_SIZE, FULL_IMAGE_SPOOL_SIZE
+from krita_image_search.cassette import Cassette
+from krita_image_search.engine import SearchEngine, SearchResult, Thumbnail, SearchError, FALLBACK_IMAGE_FORMAT
+from krita_image_search.scheduler import NetworkScheduler, IMPORT
+from krita_image_search.tools.fake_server import FakeServer, ServerConfig
+from krita_image_search.tools.replay_server import ReplayServer
+
+# End-to-end latency of the search and import pipeline against the stand-in server:
+#   python -m krita_image_search.tools.benchmark run --output after.json
+#   python -m krita_image_search.tools.benchmark compare before.json after.json
+# or against recorded Unsplash traffic, a cassette of the same session:
+#   python -m krita_image_search download "mountain lake" --pages 2 --per-page 10 --limit 1 --format jpg --record lake.cassette
+#   python -m krita_image_search.tools.benchmark run --cassette lake.cassette --query "mountain lake"
+
+# Network profiles, the server applies latency and bandwidth to every response
+PROFILES = {
+    "lan": ServerConfig(latency=0.002, bandwidth=100 * 1024 * 1024),
+    "4g": ServerConfig(latency=0.06, jitter=0.04, bandwidth=1.5 * 1024 * 1024),
+    "vpn": ServerConfig(latency=0.25, jitter=0.05, bandwidth=1024 * 1024)
+}
+
+# Seconds, lower is better
+TIMING_METRICS = ("timeToFirstResult", "timeToFirstThumbnail", "pageTime", "nextPageTime", "importTime")
+# Totals of one run, lower is better
+COUNT_METRICS = ("bytes", "requests")
+# Timing differences below this are noise whatever the ratio (seconds)
+MIN_DELTA = 0.005
+# Suffix of the GUI benchmark's allocation counts, stored next to their timings
+BLOCKS_SUFFIX = "/blocks"
+
+async def measure(server, query, perPage, quality, imageFormat):
+    # One cold session: first page, the next page, then importing the first result
+    logger = logging.getLogger(__name__)
+    metrics = {}
+    async with NetworkScheduler(logger) as scheduler:
+        with tempfile.TemporaryDirectory(prefix="krita_image_search_") as spoolDir:
+            engine = SearchEngine(scheduler, ThumbnailCache(THUMBNAIL_CACHE_SIZE), ResultStore(), FileSpool(spoolDir, FULL_IMAGE_SPOOL_SIZE), logger,
+                                  server.apiBaseUrl, imageFormat, imageBaseUrl=server.imageBaseUrl)
+            records = []
+            started = time.perf_counter()
+            async for event in engine.search(query, 1, perPage, quality):
+                if isinstance(event, SearchResult):
+                    metrics.setdefault("timeToFirstResult", time.perf_counter() - started)
+                    records.append(event.record)
+                elif isinstance(event, Thumbnail) and not event.partial:
+                    metrics.setdefault("timeToFirstThumbnail", time.perf_counter() - started)
+                elif isinstance(event, SearchError):
+                    raise RuntimeError(event.message)
+            metrics["pageTime"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            async for event in engine.search(query, 2, perPage, quality):
+                if isinstance(event, SearchError):
+                    raise RuntimeError(event.message)
+            metrics["nextPageTime"] = time.perf_counter() - started
+
+            download = engine.imageDownload(engine.fullImageUrl(records[0].fullUrl), records[0].downloadLocation)
+            started = time.perf_counter()
+            await scheduler.run(IMPORT, "benchmark import", download.run)
+            if not download.delivered:
+                raise RuntimeError("Import failed")
+            metrics["importTime"] = time.perf_counter() - started
+    return metrics
+
+async def runProfile(name, server, repeat, query, perPage, quality, imageFormat):
+    # The client gets a loop on a thread of its own, as the docker's scheduler does, so the server does not skew it
+    runs = []
+    async with server:
+        for _ in range(repeat):
+            requests = sum(server.requests.values())
+            bytesSent = sum(server.bytesSent.values())
+            clientLoop = asyncio.new_event_loop()
+            try:
+                metrics = await asyncio.get_running_loop().run_in_executor(None, clientLoop.run_until_complete, measure(server, query, perPage, quality, imageFormat))
+            finally:
+                clientLoop.close()
+            metrics["requests"] = sum(server.requests.values()) - requests
+            metrics["bytes"] = sum(server.bytesSent.values()) - bytesSent
+            runs.append(metrics)
+            print(f"{name}: " + ", ".join(f"{metric} {metrics[metric] * 1000:.0f}ms" for metric in TIMING_METRICS), file=sys.stderr)
+    # Medians, so one slow run does not move the baseline
+    results = {metric: statistics.median(run[metric] for run in runs) for metric in TIMING_METRICS}
+    results.update({metric: statistics.median_low(run[metric] for run in runs) for metric in COUNT_METRICS})
+    return results
+
+def run(args):
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "perPage": args.per_page,
+            "quality": args.quality,
+            "query": args.query,
+            "format": args.format,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "profiles": {}
+    }
+    if args.cassette is not None:
+        # One profile with the recorded timings instead of the synthetic ones
+        cassette = Cassette.load(args.cassette)
+        results["meta"].update(cassette=str(args.cassette), recorded=cassette.meta.get("recorded"), timeScale=args.time_scale)
+        servers = {"replay": lambda: ReplayServer(cassette, args.time_scale, port=0)}
+    else:
+        servers = {name: lambda name=name: FakeServer(PROFILES[name], port=0) for name in args.profiles}
+    for name, server in servers.items():
+        results["profiles"][name] = asyncio.run(runProfile(name, server(), args.repeat, args.query, args.per_page, args.quality, args.format))
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    return 0
+
+def compare(args):
+    # Flags every metric that got worse by more than the threshold, the exit code is 1 when any did
+    with open(args.baseline, encoding="utf-8") as file:
+        results = json.load(file)
+        baseline = results["profiles"]
+        # Other harnesses list which of their metrics are counts
+        counts = set(COUNT_METRICS) | set(results["meta"].get("counts", ()))
+    with open(args.current, encoding="utf-8") as file:
+        current = json.load(file)["profiles"]
+
+    regressions = 0
+    for name in baseline:
+        if name not in current:
+            print(f"{name}: missing from {args.current}")
+            continue
+        for metric, before in baseline[name].items():
+            after = current[name].get(metric)
+            if after is None:
+                continue
+            isCount = metric in counts or metric.endswith(BLOCKS_SUFFIX)
+            change = (after - before) / before if before else 0
+            regressed = change > args.threshold and (isCount or after - before > MIN_DELTA)
+            regressions += regressed
+            if isCount:
+                values = f"{before:11.0f} -> {after:11.0f}"
+            else:
+                values = f"{before * 1000:9.1f}ms -> {after * 1000:9.1f}ms"
+            print(f"{name:<5} {metric:<32} {values} {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search.tools.benchmark", description="Search and import latency against a local stand-in server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runParser = commands.add_parser("run", help="measure and write a JSON baseline")
+    runParser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES))
+    runParser.add_argument("--repeat", type=int, default=5, help="runs per profile, the median is kept (default 5)")
+    runParser.add_argument("--per-page", type=int, default=10, help="results per page, as in the docker (default 10)")
+    runParser.add_argument("--quality", type=int, default=75)
+    runParser.add_argument("--format", default=FALLBACK_IMAGE_FORMAT, help="image format, as the cassette was recorded with (default %(default)s)")
+    runParser.add_argument("--query", default="benchmark", help="the recorded query when replaying (default %(default)s)")
+    runParser.add_argument("--cassette", help="replay this cassette instead of the synthetic profiles")
+    runParser.add_argument("--time-scale", type=float, default=1, help="multiplies the cassette's recorded delays (default 1)")
+    runParser.add_argument("--output", help="JSON file, printed when not given")
+
+    compareParser = commands.add_parser("compare", help="flag regressions between two baselines")
+    compareParser.add_argument("baseline")
+    compareParser.add_argument("current")
+    compareParser.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression (default 0.1)")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    return run(args) if args.command == "run" else compare(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
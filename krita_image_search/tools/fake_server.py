@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from krita_image_search.engine import SCAN_MARKER
+from krita_image_search.records import UNSPLASH_API_URL
+from krita_image_search.vendor.aiohttp import web
+
+# Stand-in for the Unsplash proxy and the imgix image CDN, serving synthetic results and JPEGs:
+#   python -m krita_image_search.tools.fake_server --latency 0.08 --bandwidth 2000
+#   python -m krita_image_search search cats --base-url http://127.0.0.1:8765/api/unsplash
+
+API_PREFIX = "/api/unsplash"
+IMAGE_PREFIX = "/images"
+# The real API never returns more per page
+MAX_PER_PAGE = 30
+
+# 16x16 JPEGs that are padded with comment segments to any size, one baseline and one progressive with 10 scans
+BASELINE_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAA0JCgsKCA0LCgsODg0PEyAVExISEyccHhcgLikxMC4pLSwzOko+MzZGNywtQFdBRkxOUlNSMj5aYVpQYEpRUk//2wBDAQ4ODhMREyYVFSZPNS01"
+    "T09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT0//wAARCAAQABADASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgED"
+    "AwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKT"
+    "lJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcF"
+    "BAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaX"
+    "mJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwCjFD7Vcih9qlih9quRQ+1ROqZ4Wuf/2Q=="
+)
+PROGRESSIVE_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAA0JCgsKCA0LCgsODg0PEyAVExISEyccHhcgLikxMC4pLSwzOko+MzZGNywtQFdBRkxOUlNSMj5aYVpQYEpRUk//2wBDAQ4ODhMREyYVFSZPNS01"
+    "T09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT09PT0//wgARCAAQABADASIAAhEBAxEB/8QAFQABAQAAAAAAAAAAAAAAAAAAAwL/xAAUAQEAAAAAAAAAAAAAAAAA"
+    "AAAC/9oADAMBAAIQAxAAAAEGpif/xAAVEAEBAAAAAAAAAAAAAAAAAAABAP/aAAgBAQABBQIIIIL/xAAWEQADAAAAAAAAAAAAAAAAAAAAAgP/2gAIAQMBAT8Bk5//xAAWEQADAAAAAAAAAAAAAAAA"
+    "AAAAAQL/2gAIAQIBAT8BdH//xAAUEAEAAAAAAAAAAAAAAAAAAAAg/9oACAEBAAY/Ah//xAAUEAEAAAAAAAAAAAAAAAAAAAAg/9oACAEBAAE/IQq//9oADAMBAAIAAwAAABA7/8QAFBEBAAAAAAAA"
+    "AAAAAAAAAAAAAP/aAAgBAwEBPxA//8QAFBEBAAAAAAAAAAAAAAAAAAAAAP/aAAgBAgEBPxB//8QAFRABAQAAAAAAAAAAAAAAAAAAAGH/2gAIAQEAAT8Qkkkk/9k="
+)
+# Largest comment segment payload, the length field counts itself
+MAX_COMMENT = 65533
+
+# Bytes sent per write when the bandwidth is limited
+CHUNK_SIZE = 16 * 1024
+
+class ServerConfig:
+    # Everything can be changed while the server runs
+    def __init__(self, latency=0, jitter=0, bandwidth=None, errorRate=0, rateLimit=None, rateLimitWindow=3600,
+                 totalResults=300, thumbnailBytes=40 * 1024, fullBytes=2 * 1024 * 1024, seed=None,
+                 throttleRate=0, stallRate=0, stallTime=2, resetRate=0):
+        # Seconds before the response starts, plus up to jitter more
+        self.latency = latency
+        self.jitter = jitter
+        # Bytes per second for each response body, unlimited when None
+        self.bandwidth = bandwidth
+        # Fraction of requests answered with 503, and with 429 whatever the rate limit budget
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        # Fraction of responses that pause for stallTime seconds, or lose their connection, halfway through the body
+        self.stallRate = stallRate
+        self.stallTime = stallTime
+        self.resetRate = resetRate
+        # API requests allowed per window, answered with 429 once used up, unlimited when None
+        self.rateLimit = rateLimit
+        self.rateLimitWindow = rateLimitWindow
+        self.totalResults = totalResults
+        # Body size of a 500x500 q75 thumbnail, other sizes and qualities scale from it
+        self.thumbnailBytes = thumbnailBytes
+        self.fullBytes = fullBytes
+        self.seed = seed
+
+def comment(size):
+    # Comment segments totalling size bytes, markers included
+    segments = []
+    while size >= 4:
+        payload = min(size - 4, MAX_COMMENT)
+        segments.append(b"\xff\xfe" + (payload + 2).to_bytes(2, "big") + b"\0" * payload)
+        size -= payload + 4
+    return b"".join(segments)
+
+@functools.lru_cache(maxsize=64)
+def syntheticJpeg(size, progressive=False):
+    # A valid JPEG of about size bytes, padding sits before the scans so progressive ones still arrive pass by pass
+    base = PROGRESSIVE_JPEG if progressive else BASELINE_JPEG
+    parts = base.split(SCAN_MARKER)
+    padding = max(0, size - len(base))
+    scans = len(parts) - 1
+    data = [parts[0]]
+    for i, part in enumerate(parts[1:]):
+        data.append(comment(padding // scans + (padding % scans if i == 0 else 0)))
+        data.append(SCAN_MARKER + part)
+    return b"".join(data)
+
+def photoId(query, index):
+    return hashlib.sha1(f"{query}:{index}".encode("utf-8")).hexdigest()[:11]
+
+class FakeServer:
+    def __init__(self, config=None, host="127.0.0.1", port=8765):
+        self.config = config or ServerConfig()
+        self.host = host
+        self.port = port
+        self.random = random.Random(self.config.seed)
+        # Requests and body bytes by route, for harnesses to compare against
+        self.requests = Counter()
+        self.bytesSent = Counter()
+        self.resets = Counter()
+        self.loop = None
+        self.__runner = None
+        self.__thread = None
+        self.__windowStart = time.monotonic()
+        self.__used = 0
+
+        self.app = web.Application()
+        self.app.router.add_get(f"{API_PREFIX}/search", self.search)
+        self.app.router.add_get(f"{API_PREFIX}/photos/{{id}}/download", self.trackDownload)
+        self.app.router.add_get(f"{IMAGE_PREFIX}/photo-{{id}}", self.image)
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def apiBaseUrl(self):
+        return self.url + API_PREFIX
+
+    @property
+    def imageBaseUrl(self):
+        return self.url + IMAGE_PREFIX
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def start(self):
+        self.__runner = web.AppRunner(self.app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.host, self.port)
+        await site.start()
+        # Port 0 picks a free one
+        self.port = self.__runner.addresses[0][1]
+
+    async def stop(self):
+        await self.__runner.cleanup()
+
+    def startThread(self):
+        # Serves from a loop of its own, for Qt front ends that own the main thread
+        ready = threading.Event()
+        self.__thread = threading.Thread(target=self.__runLoop, args=(ready,), name="FakeServer", daemon=True)
+        self.__thread.start()
+        ready.wait()
+
+    def stopThread(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.__thread.join(5)
+
+    def __runLoop(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.stop())
+        self.loop.close()
+
+    def rateLimitHeaders(self):
+        config = self.config
+        if config.rateLimit is None:
+            return {}, True
+        if time.monotonic() - self.__windowStart >= config.rateLimitWindow:
+            self.__windowStart = time.monotonic()
+            self.__used = 0
+        allowed = self.__used < config.rateLimit
+        if allowed:
+            self.__used += 1
+        return {"X-Ratelimit-Limit": str(config.rateLimit), "X-Ratelimit-Remaining": str(config.rateLimit - self.__used)}, allowed
+
+    async def respond(self, request, route, body, contentType, headers=None, api=False):
+        # Latency, injected errors and rate limiting, then the body at the configured bandwidth
+        config = self.config
+        self.requests[route] += 1
+        await asyncio.sleep(config.latency + self.random.uniform(0, config.jitter))
+
+        headers = dict(headers or {})
+        if api:
+            rateHeaders, allowed = self.rateLimitHeaders()
+            headers.update(rateHeaders)
+            if not allowed:
+                return web.Response(status=429, text="Rate Limit Exceeded", headers=headers)
+        if self.random.random() < config.throttleRate:
+            return web.Response(status=429, text="Rate Limit Exceeded", headers=headers)
+        if self.random.random() < config.errorRate:
+            return web.Response(status=503, text="Service Unavailable", headers=headers)
+
+        resp = web.StreamResponse(headers=headers)
+        resp.content_type = contentType
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        chunkSize = len(body) if config.bandwidth is None else CHUNK_SIZE
+        halfway = len(body) // 2
+        stall = self.random.random() < config.stallRate
+        reset = self.random.random() < config.resetRate
+        if stall or reset:
+            chunkSize = max(1, min(chunkSize, halfway))
+        # Paced against the start so timer overshoot does not add up over many chunks
+        started = time.monotonic()
+        for i in range(0, len(body), max(1, chunkSize)):
+            if i >= halfway and stall:
+                stall = False
+                await asyncio.sleep(config.stallTime)
+                started += config.stallTime
+            if i >= halfway and reset:
+                self.resets[route] += 1
+                request.transport.abort()
+                # The server drops the request quietly, as for a client that went away
+                raise asyncio.CancelledError()
+            chunk = body[i:i + chunkSize]
+            await resp.write(chunk)
+            self.bytesSent[route] += len(chunk)
+            if config.bandwidth is not None:
+                await asyncio.sleep(max(0, started + (i + len(chunk)) / config.bandwidth - time.monotonic()))
+        await resp.write_eof()
+        return resp
+
+    def photoJson(self, query, index):
+        id = photoId(query, index)
+        rng = random.Random(id)
+        width = rng.choice((3000, 4000, 4500, 6000))
+        height = int(width * rng.choice((0.5, 0.66, 0.75, 1, 1.33, 1.5)))
+        return {
+            "id": id,
+            "width": width,
+            "height": height,
+            "color": "#%06x" % rng.randrange(0x1000000),
+            "blur_hash": None,
+            "description": f"{query} {index}",
+            "urls": {
+                "raw": f"{self.imageBaseUrl}/photo-{id}?ixid={id}&ixlib=rb-4.0.3",
+                "full": f"{self.imageBaseUrl}/photo-{id}?ixid={id}&ixlib=rb-4.0.3&q=85&fm=jpg&crop=entropy&cs=srgb"
+            },
+            "links": {
+                "html": f"https://unsplash.com/photos/{id}",
+                "download_location": f"{UNSPLASH_API_URL}/photos/{id}/download?ixid={id}"
+            },
+            "user": {
+                "name": f"Photographer {rng.randrange(1000)}",
+                "links": {"html": f"https://unsplash.com/@user{rng.randrange(1000)}"}
+            }
+        }
+
+    async def search(self, request):
+        query = request.query.get("query", "")
+        page = max(1, int(request.query.get("page", 1)))
+        perPage = min(MAX_PER_PAGE, max(1, int(request.query.get("per_page", 10))))
+        total = self.config.totalResults
+        start = (page - 1) * perPage
+        body = json.dumps({
+            "total": total,
+            "total_pages": -(-total // perPage),
+            "results": [self.photoJson(query, index) for index in range(start, min(total, start + perPage))]
+        }).encode("utf-8")
+        return await self.respond(request, "search", body, "application/json", api=True)
+
+    async def trackDownload(self, request):
+        id = request.match_info["id"]
+        body = json.dumps({"url": f"{self.imageBaseUrl}/photo-{id}?ixid={id}"}).encode("utf-8")
+        return await self.respond(request, "download", body, "application/json", api=True)
+
+    async def image(self, request):
+        # Thumbnails scale with the requested area and quality, anything without a size is a full image
+        params = request.query
+        progressive = params.get("fm") == "pjpg"
+        if "h" in params or "w" in params:
+            height = int(params.get("h", 500))
+            width = int(params.get("w", height))
+            size = int(self.config.thumbnailBytes * width * height / (500 * 500) * int(params.get("q", 75)) / 75)
+            route = "thumbnail"
+        else:
+            size = self.config.fullBytes
+            route = "full"
+        return await self.respond(request, route, syntheticJpeg(size, progressive), "image/jpeg")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search.tools.fake_server", description="Local stand-in for the Unsplash proxy and image CDN")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many extra seconds")
+    parser.add_argument("--bandwidth", type=float, default=None, metavar="KB", help="KB per second for each response, unlimited by default")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of requests answered with 429")
+    parser.add_argument("--stall-rate", type=float, default=0, help="fraction of responses that pause halfway")
+    parser.add_argument("--stall-time", type=float, default=2, metavar="SECONDS")
+    parser.add_argument("--reset-rate", type=float, default=0, help="fraction of responses cut off halfway")
+    parser.add_argument("--rate-limit", type=int, default=None, metavar="REQUESTS", help="API requests per window before 429")
+    parser.add_argument("--rate-limit-window", type=float, default=3600, metavar="SECONDS")
+    parser.add_argument("--total", type=int, default=300, help="results for every query")
+    parser.add_argument("--thumbnail-size", type=int, default=40, metavar="KB", help="size of a 500x500 q75 thumbnail")
+    parser.add_argument("--full-size", type=int, default=2048, metavar="KB", help="size of a full image")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    config = ServerConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth * 1024 if args.bandwidth is not None else None,
+        errorRate=args.error_rate,
+        throttleRate=args.throttle_rate,
+        stallRate=args.stall_rate,
+        stallTime=args.stall_time,
+        resetRate=args.reset_rate,
+        rateLimit=args.rate_limit,
+        rateLimitWindow=args.rate_limit_window,
+        totalResults=args.total,
+        thumbnailBytes=args.thumbnail_size * 1024,
+        fullBytes=args.full_size * 1024,
+        seed=args.seed
+    )
+
+    async def serve():
+        async with FakeServer(config, args.host, args.port) as server:
+            print(f"API base url {server.apiBaseUrl}, images from {server.imageBaseUrl}", flush=True)
+            await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from krita_image_search.tools import krita_stub
+
+# Cost of the docker's widget work under offscreen Qt, without Krita:
+#   python -m krita_image_search.tools.gui_benchmark --output gui.json
+#   python -m krita_image_search.tools.benchmark compare gui-before.json gui.json
+
+TILE_COUNTS = (10, 30, 300)
+PAGE_COUNTS = (10, 1000, 10000)
+ICON_SIZES = range(80, 501, 20)
+DOCKER_WIDTHS = range(250, 1251, 50)
+
+class Fixture:
+    # One docker and a standalone grid, shared by every measurement
+    def __init__(self):
+        # Imported here, widgets need the krita stub and a QApplication first
+        from PyQt5.QtWidgets import QWidget
+        from krita_image_search.krita_image_docker import Krita_Image_Docker
+        from krita_image_search.records import PhotoRecord
+        from krita_image_search.widgets import FlowLayout, ImageTile, PaginationWidget, TilePool
+
+        self.ImageTile = ImageTile
+        self.PaginationWidget = PaginationWidget
+        self.TilePool = TilePool
+        self.docker = Krita_Image_Docker()
+        self.docker.resize(500, 800)
+        self.docker.show()
+        self.records = [
+            PhotoRecord(f"photo{i}", "", "", "", "", f"User {i}", "", (3, 4, 6)[i % 3] * 1000, 4000, "#336699", None)
+            for i in range(max(TILE_COUNTS))
+        ]
+
+        self.grid = QWidget()
+        self.grid.setLayout(FlowLayout(self.grid))
+        self.tiles = []
+        self.pagination = None
+
+    def processEvents(self):
+        # Deferred deletes included, so freed tiles do not pile up between runs
+        from PyQt5.QtCore import QCoreApplication, QEvent
+        QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+        QCoreApplication.processEvents()
+
+    def createTiles(self, count):
+        for _ in range(count):
+            self.tiles.append(self.ImageTile(self.docker.thumbnailStore, 100, self.grid))
+
+    def deleteTiles(self):
+        layout = self.grid.layout()
+        while layout.takeAt(0) is not None:
+            pass
+        for tile in self.tiles:
+            tile.setParent(None)
+            tile.deleteLater()
+        self.tiles = []
+        self.processEvents()
+
+    def fillGrid(self, count, justified):
+        self.deleteTiles()
+        self.createTiles(count)
+        layout = self.grid.layout()
+        layout.justified = justified
+        for tile, record in zip(self.tiles, self.records):
+            tile.bind(record, None, justified)
+            layout.addWidget(tile)
+
+    def layoutGrid(self):
+        from PyQt5.QtCore import QRect
+        self.grid.layout()._do_layout(QRect(0, 0, 480, 0), False)
+
+    def newPagination(self):
+        if self.pagination is not None:
+            self.pagination.deleteLater()
+        self.pagination = self.PaginationWidget(lambda query, pageNum: None)
+        self.processEvents()
+
+    def showTiles(self, count):
+        self.docker.clearImageArea()
+        self.docker.createImageTiles(self.records[:count])
+        self.processEvents()
+
+    def clearDocker(self, coldPool=False):
+        self.docker.clearImageArea()
+        if coldPool:
+            self.docker.tilePool = self.TilePool(self.docker.newImageTile, self.docker.tilePool.maxSize)
+        self.processEvents()
+
+    def sweepIconSize(self):
+        slider = self.docker.propertiesWindow.iconSizeSlider
+        for value in ICON_SIZES:
+            slider.setValue(value)
+            self.processEvents()
+
+    def sweepWidth(self):
+        for width in DOCKER_WIDTHS:
+            self.docker.resize(width, 800)
+            self.processEvents()
+
+def qtMessage(kind, context, message):
+    # Stylesheet warnings are printed per tile and would be timed too
+    from PyQt5.QtCore import QtCriticalMsg, QtFatalMsg
+    if kind in (QtCriticalMsg, QtFatalMsg):
+        print(message, file=sys.stderr)
+
+def measure(operation, setup, repeat):
+    # Median seconds over repeat runs, then one more run under tracemalloc for the Python blocks it left allocated
+    # and its peak traced bytes, Qt's own allocations are not seen
+    times = []
+    for _ in range(repeat):
+        setup()
+        gc.collect()
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+
+    setup()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    operation()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return statistics.median(times), blocks, peak
+
+def benchmarks(fixture):
+    # (name, operation, setup, items the cost is divided by)
+    for count in TILE_COUNTS:
+        yield f"tileInit/{count}", lambda count=count: fixture.createTiles(count), fixture.deleteTiles, count
+    for count in TILE_COUNTS:
+        yield f"flowLayout/{count}", fixture.layoutGrid, lambda count=count: fixture.fillGrid(count, False), count
+        yield f"justifiedLayout/{count}", fixture.layoutGrid, lambda count=count: fixture.fillGrid(count, True), count
+    fixture.deleteTiles()
+
+    for count in PAGE_COUNTS:
+        # The first update creates a button per page, later ones only rebuild the visible window
+        yield f"paginationInit/{count}", lambda count=count: fixture.pagination.update(1, 2, count), fixture.newPagination, count
+        yield f"paginationPage/{count}", lambda count=count: fixture.pagination.update(count // 2, 2, count), lambda count=count: (fixture.newPagination(), fixture.pagination.update(1, 2, count)), 1
+
+    for count in TILE_COUNTS:
+        yield f"createImageTilesCold/{count}", lambda count=count: fixture.docker.createImageTiles(fixture.records[:count]), lambda: fixture.clearDocker(True), count
+        yield f"createImageTiles/{count}", lambda count=count: fixture.docker.createImageTiles(fixture.records[:count]), fixture.clearDocker, count
+        yield f"iconSizeSweep/{count}", fixture.sweepIconSize, lambda count=count: fixture.showTiles(count), len(ICON_SIZES)
+        yield f"dockerResize/{count}", fixture.sweepWidth, lambda count=count: fixture.showTiles(count), len(DOCKER_WIDTHS)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search.tools.gui_benchmark", description="Layout, tile and pagination costs under offscreen Qt")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per operation, the median is kept (default 5)")
+    parser.add_argument("--filter", default="", help="only operations whose name contains this")
+    parser.add_argument("--output", help="JSON file in the end-to-end benchmark's format, for its compare command")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # Keeps the docker's thumbnail disk cache out of the user's
+    cacheDir = tempfile.TemporaryDirectory(prefix="krita_image_search_")
+    os.environ["XDG_CACHE_HOME"] = cacheDir.name
+    krita_stub.install()
+    from PyQt5.QtCore import qInstallMessageHandler
+    from PyQt5.QtWidgets import QApplication
+    qInstallMessageHandler(qtMessage)
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    fixture = Fixture()
+
+    metrics = {}
+    print(f"{'operation':<28} {'median':>10} {'per item':>10} {'blocks':>8} {'peak':>9}")
+    for name, operation, setup, items in benchmarks(fixture):
+        if args.filter not in name:
+            continue
+        seconds, blocks, peak = measure(operation, setup, args.repeat)
+        metrics[name] = seconds
+        metrics[f"{name}/blocks"] = blocks
+        print(f"{name:<28} {seconds * 1000:8.2f}ms {seconds / items * 1e6:8.1f}us {blocks:8d} {peak / 1024:7.0f}KB", flush=True)
+
+    if args.output is not None:
+        results = {
+            "meta": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "qpa": os.environ["QT_QPA_PLATFORM"],
+                "repeat": args.repeat,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            },
+            "profiles": {"gui": metrics}
+        }
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(json.dumps(results, indent=2) + "\n")
+
+    fixture.docker.scheduler.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import sys
+import types
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QDockWidget
+
+# Just enough of Krita's scripting module for the docker to run in a plain QApplication,
+# install() before importing krita_image_search.krita_image_docker or widgets
+
+class Action:
+    def trigger(self):
+        pass
+
+class Krita:
+    __instance = None
+
+    def __init__(self):
+        # (group, name) -> value, as strings like kritarc
+        self.settings = {}
+        self.dockWidgetFactories = []
+
+    @classmethod
+    def instance(cls):
+        if cls.__instance is None:
+            cls.__instance = cls()
+        return cls.__instance
+
+    def readSetting(self, group, name, default):
+        return self.settings.get((group, name), default)
+
+    def writeSetting(self, group, name, value):
+        self.settings[(group, name)] = value
+
+    def icon(self, name):
+        return QIcon()
+
+    def action(self, name):
+        return Action()
+
+    def addDockWidgetFactory(self, factory):
+        self.dockWidgetFactories.append(factory)
+
+class DockWidget(QDockWidget):
+    def canvasChanged(self, canvas):
+        pass
+
+class DockWidgetFactoryBase:
+    DockRight = 2
+
+class DockWidgetFactory:
+    def __init__(self, id, area, dockClass):
+        self.id = id
+        self.area = area
+        self.dockClass = dockClass
+
+def install():
+    # Leaves a real krita module alone
+    try:
+        import krita
+        return krita
+    except ImportError:
+        pass
+    module = types.ModuleType("krita")
+    for name, value in (("Krita", Krita), ("DockWidget", DockWidget), ("DockWidgetFactory", DockWidgetFactory),
+                        ("DockWidgetFactoryBase", DockWidgetFactoryBase), ("QtCore", QtCore), ("QtGui", QtGui), ("QtWidgets", QtWidgets)):
+        setattr(module, name, value)
+    module.__all__ = ["Krita", "DockWidget", "DockWidgetFactory", "DockWidgetFactoryBase", "QtCore", "QtGui", "QtWidgets"]
+    sys.modules["krita"] = module
+    return module
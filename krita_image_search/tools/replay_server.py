@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+from krita_image_search.cassette import Cassette, isTextual, requestKey
+from krita_image_search.engine import API_BASE_URL
+from krita_image_search.records import UNSPLASH_IMAGE_URL
+from krita_image_search.tools.fake_server import FakeServer
+from krita_image_search.vendor.aiohttp import web
+
+# Serves a recorded cassette offline, with the recorded time to headers and body pacing:
+#   python -m krita_image_search search "mountain lake" --format jpg --record lake.cassette
+#   python -m krita_image_search.tools.replay_server lake.cassette --time-scale 0.5
+
+class ReplayServer(FakeServer):
+    def __init__(self, cassette, timeScale=1, host="127.0.0.1", port=8765):
+        super().__init__(host=host, port=port)
+        self.cassette = cassette
+        # Recorded delays are multiplied by this, 0 serves everything at once
+        self.timeScale = timeScale
+        self.responses = cassette.byRequest()
+        # Requests served so far by requestKey, repeated requests get the recorded responses in turn
+        self.served = Counter()
+        self.misses = Counter()
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self.replay)
+
+    @property
+    def apiBaseUrl(self):
+        return self.url + urlsplit(self.cassette.meta.get("apiBaseUrl", API_BASE_URL)).path
+
+    @property
+    def imageBaseUrl(self):
+        return self.url + urlsplit(self.cassette.meta.get("imageBaseUrl", UNSPLASH_IMAGE_URL)).path
+
+    async def replay(self, request):
+        started = time.monotonic()
+        key = requestKey(request.method, request.path_qs)
+        entries = self.responses.get(key)
+        if not entries:
+            if not self.misses[key]:
+                print(f"Not in cassette: {key}", file=sys.stderr)
+            self.misses[key] += 1
+            return web.Response(status=404, text=f"Not in cassette: {key}")
+        entry = entries[min(self.served[key], len(entries) - 1)]
+        self.served[key] += 1
+        route = "api" if isTextual(entry["headers"]) else "image"
+        self.requests[route] += 1
+
+        await self.sleepUntil(started, entry["headersTime"])
+        resp = web.StreamResponse(status=entry["status"], reason=entry["reason"])
+        for name, value in entry["headers"]:
+            resp.headers.add(name, value)
+        body = self.cassette.body(entry)
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        # Chunks as they arrived when recorded, paced against the start so timer overshoot does not add up
+        offset = 0
+        for seconds, size in entry["chunks"]:
+            await self.sleepUntil(started, seconds)
+            await resp.write(body[offset:offset + size])
+            self.bytesSent[route] += size
+            offset += size
+        await resp.write_eof()
+        return resp
+
+    async def sleepUntil(self, started, seconds):
+        delay = started + seconds * self.timeScale - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search.tools.replay_server", description="Serve a recorded cassette offline")
+    parser.add_argument("cassette")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--time-scale", type=float, default=1, help="multiplies recorded delays, 0 for none (default 1)")
+    args = parser.parse_args(argv)
+
+    cassette = Cassette.load(args.cassette)
+
+    async def serve():
+        async with ReplayServer(cassette, args.time_scale, args.host, args.port) as server:
+            print(f"{len(cassette.entries)} responses recorded {cassette.meta.get('recorded')}", flush=True)
+            print(f"--base-url {server.apiBaseUrl} --image-base-url {server.imageBaseUrl}", flush=True)
+            await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from PyQt5.QtGui import QImage
+from krita_image_search.cache import parseThumbnailKey, isPartialKey
+from krita_image_search.tools import krita_stub
+from krita_image_search.tools.fake_server import FakeServer, ServerConfig, photoId
+
+# Rapid pagination, query changes, hovers and imports in the docker against a misbehaving stand-in server:
+#   python -m krita_image_search.tools.stress --profile flaky --actions 200 --output stress.json
+
+PROFILES = {
+    # Home Wi-Fi dropping out: jittery, slow, with stalls and dropped connections
+    "flaky": ServerConfig(latency=0.05, jitter=0.3, bandwidth=512 * 1024, errorRate=0.03, throttleRate=0.02, stallRate=0.05, stallTime=2, resetRate=0.05),
+    # An overloaded proxy: fast link, many 429s and 5xx
+    "overloaded": ServerConfig(latency=0.1, jitter=0.1, bandwidth=4 * 1024 * 1024, errorRate=0.15, throttleRate=0.1),
+    "clean": ServerConfig(latency=0.02, bandwidth=8 * 1024 * 1024)
+}
+
+QUERIES = ("mountain", "portrait", "cat", "forest", "city night", "hands", "ocean", "horse")
+# Relative weight of each scripted action
+ACTIONS = (("nextPage", 45), ("previousPage", 10), ("changeQuery", 20), ("hover", 15), ("importImage", 10))
+# Pause after each action (seconds), hammering is the point
+MIN_PAUSE = 0.02
+MAX_PAUSE = 0.3
+# GUI work longer than a frame counts as stall time
+FRAME = 0.016
+SETTLE_TIMEOUT = 20
+
+# Metrics compare reads as counts rather than seconds, all of them lower is better
+COUNT_METRICS = ("wastedBytes", "staleTiles", "staleThumbnails", "brokenThumbnails", "peakThreads", "peakJobs")
+
+class Monitor:
+    # Times every slice of GUI-thread work and checks what the docker shows after each one
+    def __init__(self, app, docker, server):
+        self.app = app
+        self.docker = docker
+        self.server = server
+        self.query = None
+        self.pageNum = 1
+        self.maxStall = 0
+        self.stallTime = 0
+        self.peakThreads = 0
+        self.peakJobs = 0
+        self.usefulBytes = 0
+        self.imports = 0
+        self.staleTiles = set()
+        self.staleThumbnails = set()
+        self.brokenThumbnails = set()
+        self.shownKeys = set()
+
+        # Count delivered imports, the docker connects this by name for every import
+        copyToClipboard = docker.copyToClipboard
+        def countImport(data):
+            self.imports += 1
+            self.usefulBytes += len(data)
+            copyToClipboard(data)
+        docker.copyToClipboard = countImport
+
+    def run(self, work, *args):
+        start = time.perf_counter()
+        work(*args)
+        elapsed = time.perf_counter() - start
+        self.maxStall = max(self.maxStall, elapsed)
+        self.stallTime += max(0, elapsed - FRAME)
+        self.sample()
+
+    def pump(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            self.run(self.app.processEvents)
+            time.sleep(0.002)
+
+    def searched(self, query, pageNum):
+        # What the docker was last asked to show, tiles of anything else are stale
+        self.query = query
+        self.pageNum = pageNum
+
+    def sample(self):
+        threads = sum(1 for thread in threading.enumerate() if thread.name != "FakeServer")
+        self.peakThreads = max(self.peakThreads, threads)
+        self.peakJobs = max(self.peakJobs, len(self.docker.scheduler.jobs()))
+
+        perPage = self.docker.propertiesWindow.perPage
+        for index, imageTile in enumerate(self.docker.imageTiles):
+            record = imageTile.record
+            if record is None:
+                continue
+            if record.id != photoId(self.query, (self.pageNum - 1) * perPage + index):
+                self.staleTiles.add((self.query, self.pageNum, index, record.id))
+            key = imageTile.key
+            if key is None:
+                continue
+            if parseThumbnailKey(key)[0] != record.id:
+                self.staleThumbnails.add((record.id, key))
+            elif not isPartialKey(key) and key not in self.shownKeys:
+                self.shownKeys.add(key)
+                data = self.docker.thumbnailCache.get(key)
+                if data is None or QImage.fromData(data).isNull():
+                    self.brokenThumbnails.add(key)
+                else:
+                    self.usefulBytes += len(data)
+
+    def idle(self):
+        docker = self.docker
+        return docker.imageSearchWorker is None and not docker.importWorkers and docker.prefetchWorker is None and not docker.scheduler.jobs()
+
+class Script:
+    # Seeded sequence of user actions, each one goes through the docker's own entry points
+    def __init__(self, monitor, seed):
+        self.monitor = monitor
+        self.docker = monitor.docker
+        self.random = random.Random(seed)
+        self.query = self.random.choice(QUERIES)
+        self.pageNum = 1
+        self.hoveredTile = None
+        self.counts = dict.fromkeys((name for name, _ in ACTIONS), 0)
+
+    def start(self):
+        self.changeQuery()
+
+    def step(self):
+        names, weights = zip(*ACTIONS)
+        name = self.random.choices(names, weights)[0]
+        self.counts[name] += 1
+        self.leave()
+        getattr(self, name)()
+
+    def search(self, pageNum):
+        # As the pagination buttons do
+        self.pageNum = pageNum
+        self.monitor.searched(self.query, pageNum)
+        self.docker.searchImage(self.query, pageNum)
+
+    def nextPage(self):
+        self.search(self.pageNum + 1)
+
+    def previousPage(self):
+        self.search(max(1, self.pageNum - 1))
+
+    def changeQuery(self):
+        self.query = self.random.choice([query for query in QUERIES if query != self.query])
+        self.pageNum = 1
+        self.monitor.searched(self.query, 1)
+        self.docker.searchBar.setText(self.query)
+        self.docker.searchBar.returnPressed.emit()
+
+    def shownTiles(self):
+        return [imageTile for imageTile in self.docker.imageTiles if imageTile.record is not None]
+
+    def hover(self):
+        tiles = self.shownTiles()
+        if tiles:
+            self.hoveredTile = self.random.choice(tiles)
+            self.hoveredTile.hovered.emit(True)
+
+    def leave(self):
+        if self.hoveredTile is not None:
+            self.hoveredTile.hovered.emit(False)
+            self.hoveredTile = None
+
+    def importImage(self):
+        tiles = self.shownTiles()
+        if tiles:
+            self.random.choice(tiles).imageBtn.click()
+
+def qtMessage(kind, context, message):
+    # Stylesheet warnings are printed per tile and would be timed too
+    from PyQt5.QtCore import QtCriticalMsg, QtFatalMsg
+    if kind in (QtCriticalMsg, QtFatalMsg):
+        print(message, file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m krita_image_search.tools.stress", description="Rapid navigation against a faulty stand-in server")
+    parser.add_argument("--profile", choices=list(PROFILES), default="flaky")
+    parser.add_argument("--actions", type=int, default=100, help="scripted user actions (default 100)")
+    parser.add_argument("--seed", type=int, default=1, help="seeds the script and the server's faults (default 1)")
+    parser.add_argument("--per-page", type=int, default=10)
+    parser.add_argument("--progressive", action="store_true", help="with progressive thumbnails")
+    parser.add_argument("--output", help="JSON file in the end-to-end benchmark's format, for its compare command")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # A cold thumbnail disk cache, and the user's left alone
+    cacheDir = tempfile.TemporaryDirectory(prefix="krita_image_search_")
+    os.environ["XDG_CACHE_HOME"] = cacheDir.name
+
+    config = PROFILES[args.profile]
+    config.seed = args.seed
+    server = FakeServer(config, port=0)
+    server.startThread()
+
+    kritaModule = krita_stub.install()
+    settings = kritaModule.Krita.instance()
+    settings.writeSetting("KritaImageSearch", "ApiBaseUrl", server.apiBaseUrl)
+    settings.writeSetting("KritaImageSearch", "ImagesPerPage", str(args.per_page))
+    settings.writeSetting("KritaImageSearch", "ProgressiveThumbnails", str(int(args.progressive)))
+    from PyQt5.QtCore import qInstallMessageHandler
+    from PyQt5.QtWidgets import QApplication
+    qInstallMessageHandler(qtMessage)
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    from krita_image_search.krita_image_docker import Krita_Image_Docker
+
+    docker = Krita_Image_Docker()
+    docker.resize(500, 800)
+    docker.show()
+    monitor = Monitor(app, docker, server)
+    script = Script(monitor, args.seed)
+
+    started = time.monotonic()
+    monitor.run(script.start)
+    for _ in range(args.actions):
+        monitor.pump(script.random.uniform(MIN_PAUSE, MAX_PAUSE))
+        monitor.run(script.step)
+    script.leave()
+
+    # Let whatever is still running finish, so every byte it costs is counted
+    settleStart = time.monotonic()
+    while not monitor.idle() and time.monotonic() - settleStart < SETTLE_TIMEOUT:
+        monitor.pump(0.05)
+    settled = monitor.idle()
+    elapsed = time.monotonic() - started
+
+    docker.scheduler.stop()
+    server.stopThread()
+
+    imageBytes = server.bytesSent["thumbnail"] + server.bytesSent["full"]
+    metrics = {
+        "wastedBytes": max(0, imageBytes - monitor.usefulBytes),
+        "staleTiles": len(monitor.staleTiles),
+        "staleThumbnails": len(monitor.staleThumbnails),
+        "brokenThumbnails": len(monitor.brokenThumbnails),
+        "peakThreads": monitor.peakThreads,
+        "peakJobs": monitor.peakJobs,
+        "maxStall": monitor.maxStall,
+        "stallTime": monitor.stallTime
+    }
+
+    print(f"{args.actions} actions in {elapsed:.1f}s ({', '.join(f'{name} {count}' for name, count in script.counts.items())}), {'settled' if settled else 'still busy after ' + str(SETTLE_TIMEOUT) + 's'}")
+    print(f"server: {dict(server.requests)} requests, {dict(server.resets)} resets")
+    print(f"image bytes {imageBytes / 1024 / 1024:.2f} MB, shown or imported {monitor.usefulBytes / 1024 / 1024:.2f} MB, wasted {metrics['wastedBytes'] / 1024 / 1024:.2f} MB")
+    print(f"stale tiles {metrics['staleTiles']}, stale thumbnails {metrics['staleThumbnails']}, broken thumbnails {metrics['brokenThumbnails']}, imports {monitor.imports}")
+    print(f"peak threads {monitor.peakThreads}, peak jobs {monitor.peakJobs}")
+    print(f"GUI thread: longest slice {monitor.maxStall * 1000:.1f}ms, {monitor.stallTime * 1000:.0f}ms over {FRAME * 1000:.0f}ms frames")
+
+    if args.output is not None:
+        results = {
+            "meta": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "profile": args.profile,
+                "actions": args.actions,
+                "seed": args.seed,
+                "settled": settled,
+                "counts": list(COUNT_METRICS),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            },
+            "profiles": {args.profile: metrics}
+        }
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(json.dumps(results, indent=2) + "\n")
+    return 0 if settled else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,12 @@
-from PyQt5.QtWidgets import QLayout, QSizePolicy, QPushButton, QHBoxLayout, QVBoxLayout, QWidget, QSlider, QFormLayout, QFrame, QSpinBox, QRadioButton
-from PyQt5.QtCore import Qt, QRect, QSize, QMargins, QPoint, QUrl, pyqtSignal
-from PyQt5.QtGui import QIcon, QPixmap, QPalette, QCursor, QIcon, QDesktopServices, QFontMetrics
+from PyQt5.QtWidgets import QLayout, QSizePolicy, QPushButton, QHBoxLayout, QVBoxLayout, QWidget, QSlider, QFormLayout, QFrame, QSpinBox, QRadioButton, QLabel, QCheckBox
+from PyQt5.QtCore import Qt, QRect, QSize, QMargins, QPoint, QUrl, QTimer, pyqtSignal
+from PyQt5.QtGui import QIcon, QPixmap, QPalette, QCursor, QIcon, QDesktopServices, QFontMetrics, QPainter, QColor, QGuiApplication
 from krita_image_search.resources import *
 from krita import *
 
+# Diagnostics window refresh while shown (ms)
+DIAGNOSTICS_REFRESH = 1000
+
 class FlowLayout(QLayout):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -12,6 +15,9 @@ class FlowLayout(QLayout):
             self.setContentsMargins(QMargins(0, 0, 0, 0))
 
         self._item_list = []
+        # Justified mode scales each row of aspect-preserving tiles to fill the width
+        self.justified = False
+        self.rowHeight = 100
 
     def __del__(self):
         item = self.takeAt(0)
@@ -62,7 +68,14 @@ class FlowLayout(QLayout):
         size += QSize(2 * self.contentsMargins().top(), 2 * self.contentsMargins().top())
         return size
 
+    def _item_spacing(self, item, orientation):
+        style = item.widget().style()
+        return self.spacing() + style.layoutSpacing(QSizePolicy.PushButton, QSizePolicy.PushButton, orientation)
+
     def _do_layout(self, rect, test_only):
+        if self.justified:
+            return self._do_justified_layout(rect, test_only)
+
         x = rect.x()
         y = rect.y()
         line_height = 0
@@ -93,6 +106,45 @@ class FlowLayout(QLayout):
 
         return y + line_height - rect.y()
 
+    def _do_justified_layout(self, rect, test_only):
+        if not self._item_list:
+            return 0
+
+        space_x = self._item_spacing(self._item_list[0], Qt.Horizontal)
+        space_y = self._item_spacing(self._item_list[0], Qt.Vertical)
+        y = rect.y()
+        row = []
+        row_aspect = 0
+
+        for item in self._item_list:
+            aspect = getattr(item.widget(), "aspectRatio", 1)
+            row.append((item, aspect))
+            row_aspect += aspect
+            gaps = space_x * (len(row) - 1)
+            if row_aspect * self.rowHeight + gaps >= rect.width():
+                # Row is full, shrink its height so it spans the width exactly
+                height = max(1, int((rect.width() - gaps) / row_aspect))
+                self._place_row(row, rect, y, height, space_x, test_only)
+                y += height + space_y
+                row = []
+                row_aspect = 0
+
+        if row:
+            self._place_row(row, rect, y, self.rowHeight, space_x, test_only)
+            return y + self.rowHeight - rect.y()
+
+        return y - space_y - rect.y()
+
+    def _place_row(self, row, rect, y, height, space_x, test_only):
+        if test_only:
+            return
+
+        x = rect.x()
+        for item, aspect in row:
+            width = max(1, int(height * aspect))
+            item.setGeometry(QRect(x, y, width, height))
+            x += width + space_x
+
 class PaginationWidget(QWidget):
     __currentPage = 1
     __pageOffset = 0
@@ -212,13 +264,17 @@ class PaginationWidget(QWidget):
         self.lastBtn.setDisabled(True)
 
 class PropertiesWindow(QFrame):
-    def __init__(self, parent, background_color, initIconSize, initPerPage, initQuality, propBtn):
+    def __init__(self, parent, background_color, initIconSize, initPerPage, initQuality, initMemoryBudget, initJustified, initLiveSearch, initProgressive, propBtn):
         super().__init__(parent)
         self.setLayout(QFormLayout())
         self.padding = 10
         self.iconSize = initIconSize
         self.perPage = initPerPage
         self.quality = initQuality
+        self.memoryBudget = initMemoryBudget
+        self.justified = initJustified
+        self.liveSearch = initLiveSearch
+        self.progressive = initProgressive
         self.propBtn = propBtn
         
         self.setFrameStyle(QFrame.StyledPanel | QFrame.Raised)
@@ -252,9 +308,46 @@ class PropertiesWindow(QFrame):
         self.iconSizeSlider.valueChanged.connect(self.updateIconSize)
         self.iconSizeSlider.sliderReleased.connect(lambda: self.saveProperties("IconSize", self.iconSize))
 
+        # Justified rows checkbox, keeps each photo's aspect ratio instead of square crops
+        self.justifiedCheckbox = QCheckBox(self)
+        self.justifiedCheckbox.setChecked(self.justified)
+        self.justifiedCheckbox.toggled.connect(self.updateJustified)
+
+        # Live search checkbox, searches while typing instead of on Enter
+        self.liveSearchCheckbox = QCheckBox(self)
+        self.liveSearchCheckbox.setChecked(self.liveSearch)
+        self.liveSearchCheckbox.toggled.connect(self.updateLiveSearch)
+
+        # Progressive thumbnails checkbox, visible tiles sharpen while their bytes are still arriving
+        self.progressiveCheckbox = QCheckBox(self)
+        self.progressiveCheckbox.setChecked(self.progressive)
+        self.progressiveCheckbox.toggled.connect(self.updateProgressive)
+
+        # Thumbnail memory budget spinbox (MB)
+        self.memoryBudgetSpinbox = QSpinBox(self)
+        self.memoryBudgetSpinbox.setMinimum(16)
+        self.memoryBudgetSpinbox.setMaximum(2048)
+        self.memoryBudgetSpinbox.setSuffix(" MB")
+        self.memoryBudgetSpinbox.setValue(self.memoryBudget)
+        self.memoryBudgetSpinbox.valueChanged.connect(self.updateMemoryBudget)
+
+        # Thumbnail memory usage readout
+        self.memoryUsageLabel = QLabel(self)
+        self.updateMemoryUsage(0, 0, self.memoryBudget * 1024 * 1024)
+
+        # Opens the diagnostics window, the docker connects it
+        self.diagnosticsButton = QPushButton("Show", self)
+        self.diagnosticsButton.clicked.connect(self.hide)
+
         self.layout().addRow("&Images Per Page:", self.perPageSpinbox)
         self.layout().addRow("&Quality:", self.qualitySpinbox)
         self.layout().addRow("&Icon Size:", self.iconSizeSlider)
+        self.layout().addRow("&Justified Rows:", self.justifiedCheckbox)
+        self.layout().addRow("&Live Search:", self.liveSearchCheckbox)
+        self.layout().addRow("&Progressive Thumbnails:", self.progressiveCheckbox)
+        self.layout().addRow("&Memory Budget:", self.memoryBudgetSpinbox)
+        self.layout().addRow("Memory Usage:", self.memoryUsageLabel)
+        self.layout().addRow("&Diagnostics:", self.diagnosticsButton)
         self.setLayout(QHBoxLayout())
         self.hide()
         self.propBtn.clicked.connect(self.toggleHidden)
@@ -274,6 +367,25 @@ class PropertiesWindow(QFrame):
         self.quality = value
         self.saveProperties("Quality", self.quality)
 
+    def updateJustified(self, checked):
+        self.justified = checked
+        self.saveProperties("JustifiedRows", int(self.justified))
+
+    def updateLiveSearch(self, checked):
+        self.liveSearch = checked
+        self.saveProperties("LiveSearch", int(self.liveSearch))
+
+    def updateProgressive(self, checked):
+        self.progressive = checked
+        self.saveProperties("ProgressiveThumbnails", int(self.progressive))
+
+    def updateMemoryBudget(self, value):
+        self.memoryBudget = value
+        self.saveProperties("ThumbnailMemoryBudget", self.memoryBudget)
+
+    def updateMemoryUsage(self, decoded, encoded, budget):
+        self.memoryUsageLabel.setText(f"{decoded / (1024 * 1024):.1f} / {budget / (1024 * 1024):.0f} MB ({encoded / (1024 * 1024):.1f} MB compressed)")
+
     def toggleHidden(self):
         if self.isHidden():
             self.show()
@@ -284,20 +396,106 @@ class PropertiesWindow(QFrame):
     def saveProperties(self, name, value):
         Krita.instance().writeSetting("KritaImageSearch", name, str(value))
 
+class DiagnosticsWindow(QFrame):
+    # Live performance numbers, collect() returns (name, text) rows and is polled while the window is shown
+    def __init__(self, parent, collect):
+        super().__init__(parent)
+        self.collect = collect
+        self.valueLabels = {}
+        self.setWindowFlags(Qt.Tool | Qt.WindowStaysOnTopHint)
+        self.setWindowTitle("Krita Image Search Diagnostics")
+        self.setLayout(QVBoxLayout())
+
+        self.rows = QFormLayout()
+        self.layout().addLayout(self.rows)
+
+        # Copies the numbers as text, for pasting into a bug report
+        self.copyButton = QPushButton("Copy", self)
+        self.copyButton.clicked.connect(self.copyToClipboard)
+        self.layout().addWidget(self.copyButton, 0, Qt.AlignRight)
+
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setInterval(DIAGNOSTICS_REFRESH)
+        self.refreshTimer.timeout.connect(self.refresh)
+        self.hide()
+
+    def refresh(self):
+        for name, text in self.collect():
+            label = self.valueLabels.get(name)
+            if label is None:
+                label = QLabel(self)
+                label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+                self.valueLabels[name] = label
+                self.rows.addRow(f"{name}:", label)
+            label.setText(text)
+
+    def copyToClipboard(self):
+        QGuiApplication.clipboard().setText("\n".join(f"{name}: {label.text()}" for name, label in self.valueLabels.items()))
+
+    def toggleHidden(self):
+        if self.isHidden():
+            self.show()
+            self.raise_()
+        else:
+            self.hide()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.refreshTimer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.refreshTimer.stop()
+
+class ThumbnailButton(QPushButton):
+    # Paints the thumbnail straight from the store so evicted pixmaps are not kept alive by a QIcon
+    def __init__(self, key, store, parent=None):
+        super().__init__(parent)
+        self.key = key
+        self.store = store
+        self.placeholderColor = None
+
+    def sizeHint(self):
+        return self.iconSize()
+
+    def minimumSizeHint(self):
+        return QSize(0, 0)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        pixmap = self.store.pixmap(self.key) if self.key is not None else QPixmap()
+        if pixmap.isNull():
+            # Reserved slot, show the photo's average color until the thumbnail arrives
+            if self.placeholderColor is not None:
+                painter = QPainter(self)
+                painter.fillRect(self.rect(), self.placeholderColor)
+                painter.end()
+            return
+
+        target = QRect(QPoint(0, 0), pixmap.size().scaled(self.size(), Qt.KeepAspectRatio))
+        target.moveCenter(self.rect().center())
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawPixmap(target, pixmap)
+        painter.end()
+
 class ImageTile(QWidget):
     hovered = pyqtSignal(bool)
 
-    def __init__(self, image_data, onClickCallback, iconSize, json, parent=None):
+    def __init__(self, store, iconSize, parent=None):
         super().__init__(parent)
+        self.key = None
+        self.record = None
+        self.onClickCallback = None
+        self.aspectRatio = 1
         self.setLayout(QHBoxLayout())
+        self.defaultMargins = self.layout().contentsMargins()
 
-        pixmap = QPixmap()
-        pixmap.loadFromData(image_data)
-        image = QIcon(pixmap)
-        self.imageBtn = QPushButton(image, "", self)
+        self.imageBtn = ThumbnailButton(None, store, self)
         self.imageBtn.setFlat(True)
         self.imageBtn.setCursor(QCursor(Qt.PointingHandCursor))
-        self.imageBtn.clicked.connect(onClickCallback)
+        self.imageBtn.clicked.connect(self.onClick)
         self.imageBtn.setLayout(QVBoxLayout())
         self.imageBtn.layout().setContentsMargins(0, 0, 0, 0)
         self.imageBtn.layout().setSpacing(0)
@@ -305,18 +503,17 @@ class ImageTile(QWidget):
         self.imageBtn.setIconSize(QSize(iconSize, iconSize))
         self.imageBtn.setStyleSheet("QPushButton#imageBtn { border:none; padding: 0 -2px 0 -2px }")
 
-        # Detail Mode - also add additional info from json
+        # Detail Mode - links are filled in from the photo record when the tile is bound
         self.detailSection = QWidget(self)
         self.detailSection.setLayout(QHBoxLayout())
-        redirectUrl = f"{json['user']['links']['html']}?utm_source=krita_image_search&utm_medium=referral"
-        userLink = ImageLink(redirectUrl, text=json['user']['name'], alignment="left", parent=self.detailSection)
-        userLink.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed))
+        self.userLink = ImageLink("", alignment="left", parent=self.detailSection)
+        self.userLink.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed))
 
         linkIcon = Krita.instance().icon("link")
-        fullImageLink = ImageLink(json['links']['html'], icon=linkIcon, parent=self.detailSection)
+        self.fullImageLink = ImageLink("", icon=linkIcon, parent=self.detailSection)
 
-        self.detailSection.layout().addWidget(userLink)
-        self.detailSection.layout().addWidget(fullImageLink)
+        self.detailSection.layout().addWidget(self.userLink)
+        self.detailSection.layout().addWidget(self.fullImageLink)
         self.detailSection.layout().setAlignment(Qt.AlignLeft)
         self.detailSection.setStyleSheet("background-color: rgba(0, 0, 0, 0.5)")
         self.detailSection.layout().setContentsMargins(5, 5, 5, 5)
@@ -328,8 +525,41 @@ class ImageTile(QWidget):
         self.imageBtn.layout().addStretch()
         self.imageBtn.layout().addWidget(self.detailSection)
 
+    def bind(self, record, onClickCallback, justified=False):
+        self.record = record
+        self.onClickCallback = onClickCallback
+        self.aspectRatio = record.aspectRatio if justified else 1
+        self.imageBtn.placeholderColor = QColor(record.color) if record.color else None
+        self.layout().setContentsMargins(QMargins(0, 0, 0, 0) if justified else self.defaultMargins)
+
+        redirectUrl = f"{record.userLink}?utm_source=krita_image_search&utm_medium=referral"
+        self.userLink.setLink(redirectUrl, record.userName)
+        self.fullImageLink.setLink(record.htmlLink)
+        self.imageBtn.update()
+
+    def setThumbnail(self, key):
+        self.key = key
+        self.imageBtn.key = key
+        self.imageBtn.update()
+
+    def unbind(self):
+        self.key = None
+        self.record = None
+        self.imageBtn.key = None
+        self.imageBtn.placeholderColor = None
+        self.aspectRatio = 1
+        self.onClickCallback = None
+        self.userLink.setLink("", "")
+        self.fullImageLink.setLink("")
+        self.detailSection.hide()
+
+    def onClick(self):
+        if self.onClickCallback is not None:
+            self.onClickCallback()
+
     def updateIconSize(self, value):
         self.imageBtn.setIconSize(QSize(value, value))
+        self.imageBtn.updateGeometry()
 
     def enterEvent(self, event):
         self.hovered.emit(True)
@@ -345,6 +575,33 @@ class ImageTile(QWidget):
         else:
             self.detailSection.hide()
 
+class TilePool:
+    # Recycles ImageTile widgets across pages instead of creating new ones per result
+    def __init__(self, factory, maxSize):
+        self.factory = factory
+        self.maxSize = maxSize
+        self.__free = []
+        self.__created = 0
+
+    def acquire(self):
+        if self.__free:
+            return self.__free.pop()
+
+        self.__created += 1
+        return self.factory()
+
+    def release(self, tile):
+        tile.unbind()
+        tile.hide()
+        if len(self.__free) < self.maxSize:
+            self.__free.append(tile)
+        else:
+            self.__created -= 1
+            tile.deleteLater()
+
+    def createdCount(self):
+        return self.__created
+
 class ImageLink(QPushButton):
     def __init__(self, link, text="", alignment="center", icon=None, parent=None):
         if icon is None:
@@ -356,9 +613,19 @@ class ImageLink(QPushButton):
         
         self.style = f"font-weight: bold; cursor: pointer; text-overflow: ellipsis; text-align: {alignment};"
         self.setFlat(True)
+        self.link = link
         self.fullText = text
         self.setStyleSheet(self.style)
-        self.clicked.connect(lambda: QDesktopServices.openUrl(QUrl(link, QUrl.TolerantMode)))
+        self.clicked.connect(self.openLink)
+
+    def setLink(self, link, text=None):
+        self.link = link
+        if text is not None:
+            self.fullText = text
+            self.setText(QFontMetrics(self.font()).elidedText(self.fullText, Qt.ElideRight, self.width()))
+
+    def openLink(self):
+        QDesktopServices.openUrl(QUrl(self.link, QUrl.TolerantMode))
 
     def enterEvent(self, event):
         self.setStyleSheet(self.style + "text-decoration: underline")
@@ -1,128 +1,104 @@
-import asyncio
-from krita_image_search.vendor import aiohttp
-from PyQt5.QtCore import QObject, QByteArray, pyqtSignal
+import functools
+from krita_image_search.engine import IMAGE_FORMATS, FALLBACK_IMAGE_FORMAT, PROGRESSIVE_IMAGE_FORMAT
+from PyQt5.QtCore import Qt, QObject, QByteArray, QBuffer, QIODevice, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QImageWriter
+
+# Qt side of the search engine, turns its callbacks into queued signals for the docker
+
+@functools.lru_cache(maxsize=None)
+def preferredImageFormat():
+    supported = {bytes(imageFormat).decode().lower() for imageFormat in QImageReader.supportedImageFormats()}
+    for imageFormat in IMAGE_FORMATS:
+        if imageFormat in supported:
+            return imageFormat
+    return FALLBACK_IMAGE_FORMAT
+
+@functools.lru_cache(maxsize=None)
+def writableImageFormats():
+    return {bytes(imageFormat).decode().lower() for imageFormat in QImageWriter.supportedImageFormats()}
+
+def resizeImage(data, params):
+    # Downscales a larger cached thumbnail variant, runs on the engine's thread.
+    # Returns the encoded bytes and their fm, the requested one when Qt can write it, jpg otherwise
+    image = QImage.fromData(data)
+    if image.isNull():
+        return None
+
+    if "w" in params:
+        image = image.scaled(int(params["w"]), int(params["h"]), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    else:
+        image = image.scaledToHeight(int(params["h"]), Qt.SmoothTransformation)
+    imageFormat = params.get("fm", FALLBACK_IMAGE_FORMAT)
+    if imageFormat != PROGRESSIVE_IMAGE_FORMAT and imageFormat not in writableImageFormats():
+        imageFormat = FALLBACK_IMAGE_FORMAT
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    writer = QImageWriter(buffer, b"jpg" if imageFormat == PROGRESSIVE_IMAGE_FORMAT else imageFormat.encode())
+    writer.setQuality(int(params["q"]))
+    writer.setProgressiveScanWrite(imageFormat == PROGRESSIVE_IMAGE_FORMAT)
+    if not writer.write(image):
+        return None
+    return bytes(buffer.data()), imageFormat
 
 class SearchAPIWorker(QObject):
-    finished = pyqtSignal() 
+    finished = pyqtSignal()
     onError = pyqtSignal(str)
-    
+
     fullImageLoaded = pyqtSignal(QByteArray)
-    baseUrl = "https://joshapiproxy.fly.dev/api/unsplash"
 
-    def __init__(self, logger):
+    def __init__(self, task):
         super().__init__()
-        self.logger = logger
-        self.count_images_failed = 0
+        self.task = task
+        task.onError = lambda error: self.onError.emit(self.errorMsgFormat(error.message))
+        task.onFinished = self.finished.emit
+
+    def submit(self):
+        self.task.submit()
 
-    def errorMsgFormat(self, msg): 
-        return f"<h3 style='color:#ce3531;margin:3px'>Search Failed: {msg}</h3>"    
+    def cancel(self):
+        # Called from the GUI thread, the job stops at its next await
+        self.task.cancel()
+
+    def errorMsgFormat(self, msg):
+        return f"<h3 style='color:#ce3531;margin:3px'>Search Failed: {msg}</h3>"
 
 class ImageSearchWorker(SearchAPIWorker):
-    imLoaded = pyqtSignal(QByteArray, object)
+    # Batch of (result position, thumbnail cache key) pairs
+    imLoaded = pyqtSignal(object)
     queried = pyqtSignal(int, int)
+    # PhotoRecords in API order, emitted as results are parsed and before their thumbnails are fetched
+    listed = pyqtSignal(object)
+
+    def __init__(self, engine, query, pageNum, perPage, quality, justified, progressive=False):
+        super().__init__(engine.imageSearch(query, pageNum, perPage, quality, justified, progressive))
+        self.task.onThumbnails = self.imLoaded.emit
+        self.task.onTotal = self.queried.emit
+        self.task.onListed = self.listed.emit
 
-    def __init__(self, query, pageNum, perPage, quality, logger):
-        super().__init__(logger)
-        self.query = query
-        self.pageNum = pageNum
-        self.perPage = perPage
-        self.quality = quality
-
-
-    async def getSearchJson(self, session):
-        params = {
-            "query": self.query,
-            "page": self.pageNum,
-            "per_page": self.perPage
-        }
-        try:
-            async with session.get(f"{self.baseUrl}/search", params=params) as resp:
-                if resp.status == 429:
-                    self.onError.emit(super().errorMsgFormat("Too many requests, please try again later"))
-                elif resp.status == 200:
-                    json = await resp.json()
-                    self.queried.emit(self.pageNum, json["total_pages"])
-                    return json
-                elif resp.status >= 500:
-                    self.onError.emit(super().errorMsgFormat("Server Error"))
-                return None
-        except Exception as e:
-            self.logger.error(e)
-            self.onError.emit(super().errorMsgFormat("Server Error"))    
-            return None
-        
-    async def getImageTask(self, session, json, params, lock):
-        url = json["urls"]["raw"]
-        try:
-            async with session.get(url, params=params) as resp:
-                data = await resp.read()
-                await lock.acquire()
-                self.imLoaded.emit(data, json)
-                lock.release()
-        except Exception as e:
-            await lock.acquire()
-            self.logger.error(e)
-            self.count_images_failed += 1
-            lock.release()
-        
-    async def imSearch(self):
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            r_json = await self.getSearchJson(session)
-            if (r_json is not None):
-                tasks = []
-                thumbnailParams = {
-                    "h": 500,
-                    "w": 500,
-                    "q": self.quality,
-                    "fit": "crop",
-                    "crop": "faces,focalpoint"
-                }
-                lock = asyncio.Lock()
-                for im_result in r_json["results"]:
-                    im_result["links"]["download_location"] = im_result["links"]["download_location"].replace("https://api.unsplash.com", self.baseUrl)
-                    tasks.append(asyncio.create_task(self.getImageTask(session, im_result, thumbnailParams, lock)))
-
-                await asyncio.gather(*tasks)
-                if self.count_images_failed > 0:
-                    self.onError.emit(self.errorMsgFormat(f"Cannot load {self.count_images_failed} image(s)"))
-
-            self.finished.emit()
-        
-    def run(self):
-        asyncio.run(self.imSearch())
+    def updateViewport(self, firstVisible, lastVisible):
+        self.task.updateViewport(firstVisible, lastVisible)
 
 class ImageDownloadWorker(SearchAPIWorker):
-    def __init__(self, url, download_location, logger):
-        super().__init__(logger)
+    def __init__(self, engine, url, download_location, prefetch=False):
+        super().__init__(engine.imageDownload(url, download_location, prefetch))
+        self.task.onLoaded = self.fullImageLoaded.emit
         self.url = url
         self.download_location = download_location
 
-    async def downloadLocation(self, session):
-        try:
-            async with session.get(self.download_location) as resp:
-                if resp.status == 200:
-                    return True
-                else:
-                    return False
-        except Exception as e:
-            self.logger.error(e)
-            return False
-
-    async def download(self):
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-            downloadSuccess = await self.downloadLocation(session)
-            if downloadSuccess:
-                try:
-                    async with session.get(self.url) as resp:
-                        if resp.status == 200:
-                            data = await resp.read()
-                            self.fullImageLoaded.emit(data)
-                        elif resp.status >= 500:
-                            self.onError.emit(super().errorMsgFormat("Server Error"))
-                except Exception as e:
-                    self.logger.error(e)
-                    self.onError.emit(super().errorMsgFormat("Server Error"))
-            self.finished.emit()   
-
-    def run(self):
-        asyncio.run(self.download())
\ No newline at end of file
+    @property
+    def promoted(self):
+        return self.task.promoted
+
+    @property
+    def delivered(self):
+        return self.task.delivered
+
+    @property
+    def cancelled(self):
+        return self.task.cancelled
+
+    def promote(self):
+        self.task.promote()
+
+    def progress(self):
+        return self.task.progress()
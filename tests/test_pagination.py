@@ -0,0 +1,91 @@
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from krita_image_search.tools import krita_stub
+from krita_image_search.tools.fake_server import FakeServer, ServerConfig
+
+# Paging through many results must reuse the same tiles instead of piling up widgets or memory:
+#   python -m pytest tests
+
+PER_PAGE = 10
+PAGES = 100
+SEARCH_TIMEOUT = 10
+# Python allocations are compared from this page on, once the tiles and caches are warm
+WARM_PAGES = 10
+# Growth allowed per page after that. Compressed thumbnails, results and request timings of visited pages are kept
+# on purpose, about 40 KB a page here, anything left behind by a page on top of that is a leak
+MAX_PAGE_GROWTH = 64 * 1024
+
+class PaginationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # A cold thumbnail disk cache, and the user's left alone
+        cls.cacheDir = tempfile.TemporaryDirectory(prefix="krita_image_search_")
+        cls.xdgCacheHome = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = cls.cacheDir.name
+
+        cls.server = FakeServer(ServerConfig(totalResults=PER_PAGE * PAGES, thumbnailBytes=1024), port=0)
+        cls.server.startThread()
+
+        settings = krita_stub.install().Krita.instance()
+        settings.writeSetting("KritaImageSearch", "ApiBaseUrl", cls.server.apiBaseUrl)
+        settings.writeSetting("KritaImageSearch", "ImagesPerPage", str(PER_PAGE))
+        from PyQt5.QtWidgets import QApplication
+        cls.app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stopThread()
+        if cls.xdgCacheHome is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cls.xdgCacheHome
+        cls.cacheDir.cleanup()
+
+    def setUp(self):
+        from krita_image_search.krita_image_docker import Krita_Image_Docker
+        self.docker = Krita_Image_Docker()
+        self.docker.resize(500, 800)
+        self.docker.show()
+
+    def tearDown(self):
+        self.docker.scheduler.stop()
+        self.docker.deleteLater()
+        self.app.processEvents()
+
+    def search(self, query, pageNum):
+        self.docker.searchImage(query, pageNum)
+        deadline = time.monotonic() + SEARCH_TIMEOUT
+        while self.docker.imageSearchWorker is not None:
+            self.assertLess(time.monotonic(), deadline, f"page {pageNum} did not finish")
+            self.app.processEvents()
+            time.sleep(0.001)
+        # Deferred deletes of tiles the pool dropped
+        self.app.processEvents()
+
+    def testTilesAreReusedAcrossPages(self):
+        from krita_image_search.widgets import ImageTile
+        docker = self.docker
+        imageGrid = docker.imageArea.widget()
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        for pageNum in range(1, PAGES + 1):
+            self.search("cats", pageNum)
+            if pageNum == WARM_PAGES:
+                warm = tracemalloc.get_traced_memory()[0]
+            self.assertEqual(len(docker.imageTiles), PER_PAGE)
+            self.assertLessEqual(docker.tilePool.createdCount(), PER_PAGE)
+            self.assertLessEqual(len(imageGrid.findChildren(ImageTile)), PER_PAGE)
+            self.assertLessEqual(docker.thumbnailStore.decodedBytes(), docker.thumbnailStore.budget)
+            self.assertLessEqual(docker.thumbnailCache.size(), docker.thumbnailCache.budget)
+        growth = tracemalloc.get_traced_memory()[0] - warm
+        self.assertLess(growth, (PAGES - WARM_PAGES) * MAX_PAGE_GROWTH)
+
+if __name__ == "__main__":
+    unittest.main()